@@ -0,0 +1,193 @@
+"""取引の集計ストア
+
+transactions-YYYY-MM.json を月ごとの`TransactionBatch`としてメモリに持ち、
+日付・口座・カテゴリのインデックスと、月 x 口座 x カテゴリの集計を作っておきます。
+新しい月や取り直した月を読み込むと、その月の分だけを作り直します。
+
+金額は取引の`amount`の合計です(支出はマイナス)。
+カテゴリ・口座のないものはIDを -1 として集計します。
+
+# Usage
+
+```python
+store = TransactionStore.from_folder("data/raw")
+store.total(month="2024-05", category_id=123)
+store.rollup(by=("month", "category"), start="2024-01", end="2024-06")
+store.transactions(start="2024-05-01", end="2024-05-31", account_id=1)
+store.refresh("data/raw")  # 変わった月だけ読み直す
+
+store = TransactionStore(mt.account_table, mt.category_table)
+```
+"""
+import os
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import rawstore
+from records import Transaction, TransactionBatch
+
+KEYS = ("month", "account", "category")
+
+
+class TransactionStore:
+    """月ごとの取引と、そのインデックス・集計"""
+
+    def __init__(self,
+                 account_table: Optional[Dict[int, str]] = None,
+                 category_table: Optional[Dict[int, str]] = None):
+        self.account_table = dict(account_table or {})
+        self.category_table = dict(category_table or {})
+        # YYYY-MM → 日付順のTransactionBatch
+        self.batches: Dict[str, TransactionBatch] = {}
+        self.months: List[str] = []
+        # 口座ID/カテゴリID → {YYYY-MM: batch内の行番号のリスト}
+        self.by_account = defaultdict(dict)
+        self.by_category = defaultdict(dict)
+        # YYYY-MM → {(口座ID, カテゴリID): [金額の合計, 件数]}
+        self.rollups: Dict[str, dict] = {}
+        # rawファイル名 → sha256
+        self._files: Dict[str, str] = {}
+
+    @classmethod
+    def from_folder(cls, data_dir: str) -> "TransactionStore":
+        """download()の保存先から作る。口座名・カテゴリ名もそこから読む"""
+        store = cls()
+        store.refresh(data_dir)
+        return store
+
+    def refresh(self, data_dir: str) -> List[str]:
+        """前回から変わった月だけ読み直す。読み直した月のリストを返す"""
+        for name, table, key, field in (
+                ("account.json", self.account_table, "accounts", "nickname"),
+                ("category.json", self.category_table, "categories", "name")):
+            path = os.path.join(data_dir, name)
+            if rawstore.exists(path):
+                table.update((r["id"], r[field])
+                             for r in rawstore.load(path)[key])
+
+        updated = []
+        for path, name, digest in rawstore.changed(
+                data_dir, "transactions-*.json", self._files):
+            month = name[len("transactions-"):-len(".json")]
+            self.add_month(month, rawstore.load(path)["transactions"])
+            self._files[name] = digest
+            updated.append(month)
+        return updated
+
+    def add_month(self, month: str, transactions: list):
+        """1か月分の取引を入れる。すでにある月は置き換える"""
+        self.remove_month(month)
+        batch = TransactionBatch.from_records(
+            sorted(transactions, key=lambda t: t["date"]))
+        rollup = {}
+        for i in range(len(batch)):
+            account_id = batch.account_id[i]
+            category_id = batch.category_id[i]
+            self.by_account[account_id].setdefault(month, []).append(i)
+            self.by_category[category_id].setdefault(month, []).append(i)
+            total = rollup.setdefault((account_id, category_id), [0.0, 0])
+            total[0] += batch.amount[i]
+            total[1] += 1
+        self.batches[month] = batch
+        self.rollups[month] = rollup
+        self.months.insert(bisect_left(self.months, month), month)
+
+    def remove_month(self, month: str):
+        if month not in self.batches:
+            return
+        del self.batches[month]
+        del self.rollups[month]
+        self.months.remove(month)
+        for index in (self.by_account, self.by_category):
+            for key in [k for k, rows in index.items() if month in rows]:
+                del index[key][month]
+                if not index[key]:
+                    del index[key]
+
+    def _months(self, start: Optional[str], end: Optional[str]) -> List[str]:
+        """start〜end(YYYY-MM または YYYY-MM-DD、両端含む)にかかる月"""
+        lo = bisect_left(self.months, start[:7]) if start else 0
+        hi = bisect_right(self.months, end[:7]) if end else len(self.months)
+        return self.months[lo:hi]
+
+    def transactions(self,
+                     start: Optional[str] = None,
+                     end: Optional[str] = None,
+                     account_id: Optional[int] = None,
+                     category_id: Optional[int] = None) -> List[Transaction]:
+        """条件に合う取引を日付順に返す。start/endはYYYY-MM-DD(両端含む)"""
+        result = []
+        for month in self._months(start, end):
+            batch = self.batches[month]
+            rows = None
+            for index, key in ((self.by_account, account_id),
+                               (self.by_category, category_id)):
+                if key is None:
+                    continue
+                matched = index.get(key, {}).get(month, [])
+                rows = matched if rows is None else sorted(
+                    set(rows).intersection(matched))
+            if rows is None:
+                rows = range(len(batch))
+            dates = batch.date
+            for i in rows:
+                if start and dates[i] < start:
+                    continue
+                if end and dates[i][:len(end)] > end:
+                    continue
+                result.append(batch[i])
+        return result
+
+    def total(self,
+              month: Optional[str] = None,
+              account_id: Optional[int] = None,
+              category_id: Optional[int] = None) -> float:
+        """集計済みの金額の合計。monthを省略すると全期間"""
+        months = [month] if month else self.months
+        amount = 0.0
+        for m in months:
+            for (a, c), (value, _) in self.rollups.get(m, {}).items():
+                if account_id is not None and a != account_id:
+                    continue
+                if category_id is not None and c != category_id:
+                    continue
+                amount += value
+        return amount
+
+    def rollup(self,
+               by=KEYS,
+               start: Optional[str] = None,
+               end: Optional[str] = None) -> List[dict]:
+        """月・口座・カテゴリのうち`by`の組ごとの合計と件数。名前も付ける"""
+        unknown = set(by) - set(KEYS)
+        if unknown:
+            raise ValueError(f"unknown rollup keys: {sorted(unknown)}")
+        totals = {}
+        for month in self._months(start, end):
+            for (account_id, category_id), (value, count) in \
+                    self.rollups[month].items():
+                values = {"month": month,
+                          "account": account_id,
+                          "category": category_id}
+                key = tuple(values[k] for k in by)
+                total = totals.setdefault(key, [0.0, 0])
+                total[0] += value
+                total[1] += count
+
+        rows = []
+        for key, (value, count) in sorted(totals.items()):
+            row = {}
+            for name, k in zip(by, key):
+                if name == "month":
+                    row["month"] = k
+                elif name == "account":
+                    row["account_id"] = k
+                    row["account"] = self.account_table.get(k)
+                else:
+                    row["category_id"] = k
+                    row["category"] = self.category_table.get(k)
+            row["amount"] = value
+            row["count"] = count
+            rows.append(row)
+        return rows
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+"""複数ゲストのダウンロードと変換をプロセスプールでまとめて実行します。
+
+ゲストごとに別プロセスで download → convert → load_db を行い、
+APIへの同時リクエスト数は全プロセス合わせて`--max-requests`以下に抑えます。
+
+guests.json の例
+```json
+[
+    {"name": "alice", "folder": "data/alice", "months": 6},
+    {"name": "bob", "folder": "data/bob",
+     "token_file": "data/bob/bearer_token",
+     "env": {"MT_EMAIL": "bob@example.com"}}
+]
+```
+
+token_file を省略すると folder/bearer_token を使います。
+login.py は実行したフォルダに bearer_token を書くので、
+token_file はゲストごとに別フォルダの bearer_token にしてください
+(ファイル名が bearer_token でない設定はエラーにします)。
+envはトークンの期限が切れていたときにlogin.pyへ渡す環境変数です。
+
+# Usage
+
+```
+python3 batch.py guests.json --processes 4 --max-requests 8 --report status.json
+```
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import convert
+import load_db
+from moneytree_scraping import download
+from token_manager import TokenManager
+
+
+def token_file(guest: dict) -> str:
+    """ゲストのトークンファイル。login.pyが書くbearer_tokenでなければValueError"""
+    path = guest.get("token_file",
+                     os.path.join(guest["folder"], "bearer_token"))
+    if os.path.basename(path) != "bearer_token":
+        raise ValueError(f"token_file must be named bearer_token: {path}")
+    return path
+
+
+def run_guest(guest: dict, concurrency, workers: int) -> dict:
+    """1ゲスト分を実行して結果を返す。例外はここで受け止めて他のゲストに波及させない"""
+    start = time.time()
+    name = guest.get("name", guest["folder"])
+    raw = os.path.join(guest["folder"], "raw")
+    out = os.path.join(guest["folder"], "out")
+    try:
+        os.makedirs(raw, exist_ok=True)
+        tokens = TokenManager(token_file(guest), env=guest.get("env"))
+        failures = download(raw,
+                            tokens.get(),
+                            guest.get("months", 6),
+                            workers=workers,
+                            incremental=guest.get("incremental", True),
+                            token_refresher=tokens.refresh,
+                            concurrency=concurrency)
+        if not failures:
+            convert.convert(raw, out)
+            load_db.load(raw, os.path.join(out, "moneytree.db"))
+        return {
+            "name": name,
+            "status": "failed" if failures else "ok",
+            "failures": {os.path.basename(k): str(v)
+                         for k, v in failures.items()},
+            "seconds": round(time.time() - start, 3),
+        }
+    except Exception as e:  # ゲストごとに隔離するため全て受ける
+        return {
+            "name": name,
+            "status": "error",
+            "error": f"{type(e).__name__}: {e}",
+            "seconds": round(time.time() - start, 3),
+        }
+
+
+def run(guests: list,
+        processes: int = 4,
+        max_requests: int = 8,
+        workers: int = 4) -> list:
+    """全ゲストを実行し、ゲストごとの結果のリストを返す"""
+    # 設定の誤りは実行を始める前に知らせる
+    for guest in guests:
+        token_file(guest)
+    with multiprocessing.Manager() as manager, \
+            ProcessPoolExecutor(max_workers=processes) as executor:
+        concurrency = manager.BoundedSemaphore(max_requests)
+        futures = [
+            executor.submit(run_guest, guest, concurrency, workers)
+            for guest in guests
+        ]
+        results = []
+        for future in as_completed(futures):
+            result = future.result()
+            print(f"{result['name']}: {result['status']} "
+                  f"({result['seconds']}s)", file=sys.stderr)
+            results.append(result)
+    return sorted(results, key=lambda r: r["name"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="moneytree batch runner")
+    parser.add_argument("guests", help="ゲストの一覧(JSON)")
+    parser.add_argument("--processes", type=int, default=4,
+                        help="同時に処理するゲスト数")
+    parser.add_argument("--max-requests", type=int, default=8,
+                        help="全ゲスト合計の同時リクエスト数の上限")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="1ゲストあたりの並行リクエスト数")
+    parser.add_argument("--report", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    with open(args.guests, encoding="utf-8") as f:
+        guests = json.load(f)
+    results = run(guests, args.processes, args.max_requests, args.workers)
+    report = {
+        "ok": sum(r["status"] == "ok" for r in results),
+        "failed": sum(r["status"] != "ok" for r in results),
+        "guests": results,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if report["failed"]:
+        sys.exit(1)
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+"""モックサーバを相手にしたベンチマーク
+
+download() の所要時間・リクエスト数/秒、convert と load_db の所要時間、
+ピークメモリをいくつかのデータ規模で計測します。
+
+# Usage
+
+```
+python3 benchmark.py
+python3 benchmark.py --scale small --workers 1 4 --latency 0.05 --json out.json
+python3 benchmark.py --startup
+```
+"""
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import convert
+import load_db
+import moneytree_scraping
+from mock_server import MockServer, SyntheticData
+
+SCALES = {
+    # accounts, categories, months, transactions per month
+    "small": (3, 20, 6, 50),
+    "medium": (10, 40, 18, 400),
+    "large": (30, 60, 60, 1200),
+}
+
+# moneytree_scrapingが使うときにimportするモジュール。run()の計測には含めない
+DEFERRED_IMPORTS = ["concurrent.futures", "dateutil.relativedelta", "requests"]
+
+
+def _measure(func, *args, **kwargs):
+    """(戻り値, 経過秒, ピークメモリbyte)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run(scale: str, workers: int, latency: float = 0.0) -> dict:
+    """1つの規模・並列数で download → convert → load_db を計測する"""
+    for name in DEFERRED_IMPORTS:
+        importlib.import_module(name)
+    accounts, categories, months, transactions = SCALES[scale]
+    data = SyntheticData(accounts, categories, months, transactions)
+    with MockServer(data, latency=latency) as server, \
+            tempfile.TemporaryDirectory() as root:
+        moneytree_scraping.Moneytree.origin = server.origin
+        raw = os.path.join(root, "raw")
+        out = os.path.join(root, "out")
+        os.makedirs(raw)
+
+        failures, download_time, download_peak = _measure(
+            moneytree_scraping.download, raw, "benchmark", months,
+            workers=workers)
+        requests_count = server.request_count
+        _, convert_time, convert_peak = _measure(convert.convert, raw, out)
+        _, load_time, load_peak = _measure(load_db.load, raw,
+                                           os.path.join(out, "moneytree.db"))
+
+    return {
+        "scale": scale,
+        "workers": workers,
+        "latency": latency,
+        "failures": len(failures),
+        "requests": requests_count,
+        "bytes": server.bytes_sent,
+        "download_seconds": round(download_time, 4),
+        "requests_per_second": round(requests_count / download_time, 2),
+        "download_peak_bytes": download_peak,
+        "convert_seconds": round(convert_time, 4),
+        "convert_peak_bytes": convert_peak,
+        "load_db_seconds": round(load_time, 4),
+        "load_db_peak_bytes": load_peak,
+    }
+
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import moneytree_scraping
+imported = time.perf_counter()
+moneytree_scraping.Moneytree.origin = sys.argv[1]
+mt = moneytree_scraping.Moneytree("benchmark")
+constructed = time.perf_counter()
+mt.categories
+print(imported - start, constructed - start, time.perf_counter() - start)
+"""
+
+
+def startup(repeat: int = 5) -> dict:
+    """新しいプロセスで import → Moneytree() → 最初のリクエスト までの秒数(中央値)"""
+    samples = []
+    with MockServer(SyntheticData(3, 20, 1, 0)) as server:
+        for _ in range(repeat):
+            out = subprocess.run(
+                [sys.executable, "-c", STARTUP_SCRIPT, server.origin],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True,
+                text=True,
+                check=True).stdout
+            samples.append([float(v) for v in out.split()])
+    import_time, construct_time, first_request_time = (
+        sorted(column)[len(column) // 2] for column in zip(*samples))
+    return {
+        "import_seconds": round(import_time, 4),
+        "construct_seconds": round(construct_time, 4),
+        "first_request_seconds": round(first_request_time, 4),
+    }
+
+
+def _print(results):
+    columns = [
+        "scale", "workers", "requests", "download_seconds",
+        "requests_per_second", "convert_seconds", "load_db_seconds",
+        "download_peak_bytes", "convert_peak_bytes"
+    ]
+    print("\t".join(columns))
+    for r in results:
+        print("\t".join(str(r[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="moneytree benchmark")
+    parser.add_argument("--scale", nargs="+", choices=list(SCALES),
+                        default=["small", "medium"])
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="モックサーバの1リクエストあたりの遅延(秒)")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    parser.add_argument("--startup", action="store_true",
+                        help="起動時間(import と最初のリクエスト)だけを計測する")
+    args = parser.parse_args()
+
+    if args.startup:
+        result = startup()
+        print(json.dumps(result, indent=2))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(result, f, indent=2)
+        sys.exit()
+
+    results = [
+        run(scale, workers, args.latency) for scale in args.scale
+        for workers in args.workers
+    ]
+    _print(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if any(r["failures"] for r in results):
+        sys.exit("some requests failed")
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+"""取引の変更フィード
+
+download()で保存した transactions-YYYY-MM.json を前回の状態と比べて、
+追加・更新・削除された取引だけを追記専用のJSONLへ書き出します。
+取引は`id`で対応づけ、`updated_at`が変わっていれば更新とみなします。
+
+前回から内容の変わった月のファイルだけを比べるので、
+incrementalで取り直した月に変化がなければ何も書きません。
+別の月へ移った取引(日付の変更)は、削除+追加ではなく更新になります。
+
+1行が1つの変更です。
+```json
+{"seq": 12, "op": "update", "id": 123, "month": "2024-05",
+ "updated_at": "...", "detected_at": "...", "transaction": {...}}
+```
+削除では`transaction`はnullで、`updated_at`は最後に見えていた値です。
+
+フィードを書いてから状態を保存するので、途中で落ちると
+次回に同じ変更がもう一度書かれることがあります(少なくとも1回)。
+利用側は`seq`か(`id`, `op`, `updated_at`)で重複を除いてください。
+
+# Usage
+
+```
+python3 changefeed.py raw_dir changes.jsonl
+```
+
+```python
+from changefeed import ChangeFeed
+for change in ChangeFeed("data/changes.jsonl").read(after=seq):
+    ...
+```
+"""
+import json
+import os
+import sys
+from datetime import datetime, timezone
+from typing import Optional
+
+import rawstore
+
+STATE_SUFFIX = ".state.json"
+
+
+def _month(path: str) -> str:
+    """transactions-YYYY-MM.json → YYYY-MM"""
+    return os.path.basename(path)[len("transactions-"):-len(".json")]
+
+
+def diff(previous: dict, transactions: list, month: str) -> list:
+    """1か月分の取引を前回の状態と比べて (op, id, 取引) のリストを返す。
+
+    previousは {id: [month, updated_at]}。削除は呼び出し側で判定する。
+    """
+    changes = []
+    for t in transactions:
+        key = str(t["id"])
+        seen = previous.get(key)
+        if seen is None:
+            changes.append(("insert", key, t))
+        elif seen[1] != t.get("updated_at") or seen[0] != month:
+            changes.append(("update", key, t))
+    return changes
+
+
+class ChangeFeed:
+    """追記専用のJSONL変更フィードと、その比較元になる状態
+
+    状態は`path`の隣に`<path>.state.json`として保存します。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state_path = path + STATE_SUFFIX
+        state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+        # 最後に書いた変更の番号
+        self.seq = state.get("seq", 0)
+        # rawファイル名 → sha256
+        self.files = state.get("files", {})
+        # 取引ID(文字列) → [YYYY-MM, updated_at]
+        self.transactions = state.get("transactions", {})
+
+    def update(self, data_dir: str) -> list:
+        """data_dirの取引ファイルを前回と比べ、変更をフィードへ追記して返す"""
+        fresh = {}
+        for path, key, digest in rawstore.changed(
+                data_dir, "transactions-*.json", self.files):
+            fresh[_month(path)] = (key, digest,
+                                   rawstore.load(path)["transactions"])
+
+        changes = []
+        seen = set()
+        for month, (_, _, transactions) in sorted(fresh.items()):
+            for op, key, t in diff(self.transactions, transactions, month):
+                changes.append(self._change(op, key, month,
+                                            t.get("updated_at"), t))
+            seen.update(str(t["id"]) for t in transactions)
+        # 取り直した月にあったのに、どの月にも見つからなくなった取引
+        for key, (month, updated_at) in sorted(self.transactions.items()):
+            if month in fresh and key not in seen:
+                changes.append(self._change("delete", key, month,
+                                            updated_at, None))
+
+        self._append(changes)
+        for change in changes:
+            key = str(change["id"])
+            if change["op"] == "delete":
+                del self.transactions[key]
+            else:
+                self.transactions[key] = [change["month"],
+                                          change["updated_at"]]
+        for month, (key, digest, _) in fresh.items():
+            self.files[key] = digest
+        self._save()
+        return changes
+
+    def _change(self, op: str, key: str, month: str,
+                updated_at: Optional[str], transaction) -> dict:
+        self.seq += 1
+        return {
+            "seq": self.seq,
+            "op": op,
+            "id": int(key) if key.isdigit() else key,
+            "month": month,
+            "updated_at": updated_at,
+            "detected_at": datetime.now(timezone.utc).isoformat(),
+            "transaction": transaction,
+        }
+
+    def _append(self, changes: list):
+        if not changes:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            for change in changes:
+                f.write(json.dumps(change, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _save(self):
+        with rawstore.atomic_write(self.state_path) as f:
+            f.write(json.dumps({
+                "seq": self.seq,
+                "files": self.files,
+                "transactions": self.transactions,
+            }, sort_keys=True).encode())
+
+    def read(self, after: int = 0):
+        """`after`より後の変更を順に返す"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # 書きかけの行
+                change = json.loads(line)
+                if change["seq"] > after:
+                    yield change
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: changefeed.py raw_dir changes.jsonl")
+    changes = ChangeFeed(sys.argv[2]).update(sys.argv[1])
+    counts = {op: 0 for op in ("insert", "update", "delete")}
+    for change in changes:
+        counts[change["op"]] += 1
+    print(" ".join(f"{op}={n}" for op, n in counts.items()))
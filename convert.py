@@ -0,0 +1,171 @@
+#!/usr/bin/python
+"""moneytree_scraping.download() で保存したJSONをCSVへ変換します。
+
+以前の 2csv (yq + awk) と同じCSVを出力しますが、
+各JSONファイルは1回だけ読み込み、行をそのままCSVへ書き出します。
+
+# Usage
+
+```
+python3 convert.py raw_dir out_dir
+```
+
+または
+
+```python
+from convert import convert
+convert("data/raw", "data/out")
+```
+"""
+import csv
+import json
+import os
+import sys
+
+import rawstore
+
+TRANSACTION_COLUMNS = [
+    "id", "amount", "date", "description_guest", "description_pretty",
+    "description_raw", "raw_transaction_id", "created_at", "updated_at",
+    "expense_type", "predicted_expense_type", "category_id", "account_id",
+    "claim_id"
+]
+
+
+def _cell(value):
+    """yqのCSV出力に合わせて値を文字列化する"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def _load(data_dir: str, name: str):
+    return rawstore.load(os.path.join(data_dir, name))
+
+
+def _monthly_files(data_dir: str, prefix: str):
+    """`prefix`-YYYY-MM.json を月順に (YYYY-MM, JSON) で返す"""
+    for path in rawstore.glob(data_dir, f"{prefix}-*.json"):
+        month = os.path.basename(path)[len(prefix) + 1:-len(".json")]
+        yield month, rawstore.load(path)
+
+
+def _write(path: str, header, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow([_cell(v) for v in row])
+
+
+def _write_records(path: str, records):
+    """辞書のリストを、先頭レコードのキーをヘッダーとしてCSVにする"""
+    records = list(records)
+    header = list(records[0]) if records else []
+    _write(path, header, ([r.get(k) for k in header] for r in records))
+
+
+def snapshot_rows(snapshot):
+    for credential in snapshot["guest"]["credentials"]:
+        for account in credential["accounts"]:
+            yield [
+                credential["id"], account["id"],
+                credential["institution_name"], account["nickname"],
+                account["institution_account_number"], account["group"],
+                account["current_balance"]
+            ]
+
+
+def account_balance_rows(account_balances):
+    for account in account_balances["account_balances"]:
+        for balance in account["monthly_balances"]:
+            yield [
+                account["account_id"], balance["month"], balance["balance"],
+                balance["balance_in_base"]
+            ]
+
+
+def net_worth_by_type_rows(net_worth):
+    for type_, balances in sorted(net_worth["account_type_balances"].items()):
+        if isinstance(balances, dict):
+            balances = [balances]
+        for balance in balances:
+            yield [
+                type_, balance["month"], balance["net_worth"],
+                balance["net_worth_in_base"]
+            ]
+
+
+def spending_rows(month: str, spending):
+    for total in spending["category_totals"]:
+        for category, value in total["categories"].items():
+            yield [month, category, value]
+
+
+def spending_total_rows(month: str, spending):
+    for total in spending["category_totals"]:
+        yield [month, total["total"]]
+
+
+def transaction_rows(month: str, transactions):
+    for t in transactions["transactions"]:
+        yield [month] + [t.get(k) for k in TRANSACTION_COLUMNS]
+
+
+def convert(data_dir: str, output_dir: str):
+    """data_dirのJSONをoutput_dirのCSVへ変換する"""
+    os.makedirs(output_dir, exist_ok=True)
+
+    def out(name):
+        return os.path.join(output_dir, name)
+
+    _write(out("snapshot.csv"), [
+        "root_account_id", "account_id", "institution_name",
+        "institution_account_name", "institution_account_number", "group",
+        "balance"
+    ], snapshot_rows(_load(data_dir, "snapshot.json")))
+
+    _write_records(out("account.csv"),
+                   _load(data_dir, "account.json")["accounts"])
+
+    _write(out("account_balances.csv"),
+           ["account_id", "month", "balance", "balance_in_base"],
+           account_balance_rows(_load(data_dir, "account_balances.json")))
+
+    net_worth = _load(data_dir, "net_worth.json")
+    _write_records(out("net_worth.csv"), net_worth["net_worth"])
+    _write(out("net_worth_by_types.csv"),
+           ["type", "month", "balance", "balance_in_base"],
+           net_worth_by_type_rows(net_worth))
+
+    _write_records(out("category.csv"),
+                   _load(data_dir, "category.json")["categories"])
+
+    totals = []
+
+    def spendings():
+        for month, spending in _monthly_files(data_dir, "spending"):
+            totals.extend(spending_total_rows(month, spending))
+            yield from spending_rows(month, spending)
+
+    _write(out("spendings.csv"), ["month", "category", "value"], spendings())
+    _write(out("spendings_by_month.csv"), ["month", "amount"], totals)
+
+    _write_records(out("cash_flow.csv"), ({
+        k: v for k, v in c.items() if k != "categories"
+    } for c in _load(data_dir, "cashflow.json")["cash_flow"]))
+
+    _write(out("transactions.csv"), ["month"] + TRANSACTION_COLUMNS,
+           (row for month, transactions in _monthly_files(
+               data_dir, "transactions")
+            for row in transaction_rows(month, transactions)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: convert.py raw_dir out_dir")
+    convert(sys.argv[1], sys.argv[2])
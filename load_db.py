@@ -0,0 +1,348 @@
+#!/usr/bin/python
+"""moneytree_scraping.download() で保存したJSONをSQLiteへ直接取り込みます。
+
+テーブル名とカラム名は 2csv が出力していたCSVに合わせています。
+主キーで upsert するので毎回作り直す必要はなく、
+前回から内容の変わったファイルだけを1トランザクションで取り込みます。
+ファイルが表す範囲(取引ならその月)の行はファイルの内容で置き換えるので、
+ファイルから消えた取引などはDBからも消えます。
+
+# Usage
+
+```
+python3 load_db.py raw_dir moneytree.db
+```
+"""
+import sqlite3
+import sys
+
+import rawstore
+from convert import (TRANSACTION_COLUMNS, account_balance_rows,
+                     net_worth_by_type_rows, snapshot_rows,
+                     spending_rows, spending_total_rows, transaction_rows)
+
+SCHEMA_VERSION = 1
+# PRAGMA application_id。search_index.py などの別のDBと取り違えないための印 ("MTDB")
+APPLICATION_ID = 0x4D544442
+
+SCHEMA = """
+CREATE TABLE account (
+    id INTEGER PRIMARY KEY,
+    guest_id INTEGER,
+    nickname TEXT,
+    currency TEXT,
+    credential_id INTEGER,
+    account_type TEXT,
+    institution_account_number TEXT,
+    institution_account_name TEXT,
+    branch_name TEXT,
+    status TEXT,
+    last_success_at TEXT,
+    "group" TEXT,
+    detail_type TEXT,
+    sub_type TEXT,
+    current_balance REAL,
+    current_balance_in_base REAL,
+    current_unclosed_balance REAL,
+    current_closed_balance REAL,
+    current_revolving_balance REAL
+);
+CREATE TABLE category (
+    id INTEGER PRIMARY KEY,
+    parent_id INTEGER,
+    guest_id INTEGER,
+    category_type TEXT,
+    updated_at TEXT,
+    created_at TEXT,
+    entity_key TEXT,
+    name TEXT,
+    icon_key TEXT
+);
+CREATE TABLE snapshot (
+    root_account_id INTEGER,
+    account_id INTEGER PRIMARY KEY,
+    institution_name TEXT,
+    institution_account_name TEXT,
+    institution_account_number TEXT,
+    "group" TEXT,
+    balance REAL
+);
+CREATE TABLE account_balances (
+    account_id INTEGER,
+    month TEXT,
+    balance REAL,
+    balance_in_base REAL,
+    PRIMARY KEY (account_id, month)
+);
+CREATE TABLE net_worth (
+    month TEXT PRIMARY KEY,
+    net_worth REAL,
+    net_worth_in_base REAL
+);
+CREATE TABLE net_worth_by_types (
+    type TEXT,
+    month TEXT,
+    balance REAL,
+    balance_in_base REAL,
+    PRIMARY KEY (type, month)
+);
+CREATE TABLE cash_flow (
+    month TEXT PRIMARY KEY,
+    amount_in REAL,
+    amount_out REAL,
+    amount_total REAL
+);
+CREATE TABLE spendings (
+    month TEXT,
+    category INTEGER,
+    value REAL,
+    PRIMARY KEY (month, category)
+);
+CREATE TABLE spendings_by_month (
+    month TEXT PRIMARY KEY,
+    amount REAL
+);
+CREATE TABLE transactions (
+    month TEXT,
+    id INTEGER PRIMARY KEY,
+    amount REAL,
+    date TEXT,
+    description_guest TEXT,
+    description_pretty TEXT,
+    description_raw TEXT,
+    raw_transaction_id INTEGER,
+    created_at TEXT,
+    updated_at TEXT,
+    expense_type INTEGER,
+    predicted_expense_type INTEGER,
+    category_id INTEGER,
+    account_id INTEGER,
+    claim_id INTEGER
+);
+CREATE INDEX transactions_date ON transactions (date);
+CREATE INDEX transactions_account_id ON transactions (account_id);
+CREATE INDEX transactions_category_id ON transactions (category_id);
+CREATE INDEX account_balances_month ON account_balances (month);
+CREATE INDEX spendings_category ON spendings (category);
+CREATE TABLE loaded_files (
+    name TEXT PRIMARY KEY,
+    sha256 TEXT
+);
+"""
+
+ACCOUNT_COLUMNS = [
+    "id", "guest_id", "nickname", "currency", "credential_id",
+    "account_type", "institution_account_number", "institution_account_name",
+    "branch_name", "status", "last_success_at", "group", "detail_type",
+    "sub_type", "current_balance", "current_balance_in_base",
+    "current_unclosed_balance", "current_closed_balance",
+    "current_revolving_balance"
+]
+CATEGORY_COLUMNS = [
+    "id", "parent_id", "guest_id", "category_type", "updated_at",
+    "created_at", "entity_key", "name", "icon_key"
+]
+
+
+def _tables(conn: sqlite3.Connection) -> set:
+    return {
+        name for name, in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%'")
+    }
+
+
+def connect(path: str,
+            schema: str = SCHEMA,
+            schema_version: int = SCHEMA_VERSION,
+            application_id: int = APPLICATION_ID) -> sqlite3.Connection:
+    """DBを開く。user_versionが`schema_version`でない
+    (csv-to-sqliteで作ったものを含む)場合はすべてのテーブルを消して`schema`で作り直す。
+
+    application_idが`application_id`のDBと、印のないDBのうちテーブルが
+    すべて`schema`にあるもの(古い版や csv-to-sqlite で作ったもの)だけを扱い、
+    それ以外(別のスキーマのDB)はValueErrorにして消さない。
+    """
+    conn = sqlite3.connect(path)
+    current = conn.execute("PRAGMA application_id").fetchone()[0]
+    if current != application_id:
+        known = sqlite3.connect(":memory:")
+        known.executescript(schema)
+        if current != 0 or not _tables(conn) <= _tables(known):
+            conn.close()
+            raise ValueError(f"{path} is not a database for this schema")
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version != schema_version:
+        with conn:
+            for name in _tables(conn):
+                conn.execute(f'DROP TABLE "{name}"')
+            conn.executescript(schema)
+            conn.execute(f"PRAGMA user_version = {schema_version}")
+    if current != application_id:
+        conn.execute(f"PRAGMA application_id = {application_id}")
+    return conn
+
+
+def upsert(conn: sqlite3.Connection, table: str, columns, keys, rows,
+           compare=None) -> int:
+    """主キー`keys`でupsertする。
+
+    既存の行は`compare`のカラム(省略時はキー以外すべて)が
+    変わっているときだけ更新する。変更のあった行数を返す。
+    """
+    values = [c for c in columns if c not in keys]
+    compare = compare or values
+    quoted = ", ".join(f'"{c}"' for c in columns)
+    sql = (
+        f'INSERT INTO {table} ({quoted}) '
+        f'VALUES ({", ".join("?" * len(columns))}) '
+        f'ON CONFLICT ({", ".join(keys)}) DO UPDATE SET '
+        + ", ".join(f'"{c}" = excluded."{c}"' for c in values)
+        + " WHERE "
+        + " OR ".join(f'{table}."{c}" IS NOT excluded."{c}"' for c in compare))
+    before = conn.total_changes
+    conn.executemany(sql, rows)
+    return conn.total_changes - before
+
+
+def _records(records, columns):
+    return ([r.get(c) for c in columns] for r in records)
+
+
+def replace(conn: sqlite3.Connection, table: str, columns, keys, rows,
+            compare=None, scope=None) -> int:
+    """`upsert`したうえで、`scope`の範囲にあって`rows`にない行を消す。
+
+    scopeは (カラム, 値のリスト) で、その値の行だけを対象にする。
+    Noneならテーブル全体を`rows`で置き換える。変更のあった行数を返す。
+    """
+    rows = list(rows)
+    changes = upsert(conn, table, columns, keys, rows, compare)
+    where = ""
+    params = []
+    if scope is not None:
+        column, values = scope
+        values = sorted(set(values))
+        if not values:
+            return changes
+        where = (f' AND "{column}" IN ({", ".join("?" * len(values))})')
+        params = values
+
+    # 新しいキーを同じ型のカラムを持つ一時テーブルに入れて比べる
+    # (JSONでは文字列のIDもテーブルの型に合わせて比較するため)
+    quoted = ", ".join(f'"{k}"' for k in keys)
+    positions = [columns.index(k) for k in keys]
+    conn.execute("DROP TABLE IF EXISTS temp.new_keys")
+    conn.execute(f"CREATE TEMP TABLE new_keys AS "
+                 f"SELECT {quoted} FROM {table} WHERE 0")
+    conn.executemany(
+        f'INSERT INTO new_keys VALUES ({", ".join("?" * len(keys))})',
+        ([row[i] for i in positions] for row in rows))
+    before = conn.total_changes
+    conn.execute(
+        f"DELETE FROM {table} WHERE ({quoted}) NOT IN "
+        f"(SELECT {quoted} FROM new_keys){where}", params)
+    changes += conn.total_changes - before
+    conn.execute("DROP TABLE temp.new_keys")
+    return changes
+
+
+def _by_month(table: str, columns, keys, rows, compare=None) -> tuple:
+    """ファイルに含まれる月の行だけを置き換える`replace`の引数"""
+    i = columns.index("month")
+    return (table, columns, keys, rows, compare,
+            ("month", [row[i] for row in rows]))
+
+
+def statements(name: str, data) -> list:
+    """raw JSON 1ファイル分を`replace`の引数
+    (テーブル, カラム, キー, 行のリスト, 比較するカラム, 範囲) のリストにする。
+
+    ファイルが表す範囲(取引なら月、口座一覧ならテーブル全体)の行は
+    ファイルの内容で置き換わり、ファイルから消えた行はDBからも消える。
+    """
+    if name == "account.json":
+        return [("account", ACCOUNT_COLUMNS, ["id"],
+                 list(_records(data["accounts"], ACCOUNT_COLUMNS)), None,
+                 None)]
+    if name == "category.json":
+        return [("category", CATEGORY_COLUMNS, ["id"],
+                 list(_records(data["categories"], CATEGORY_COLUMNS)),
+                 ["updated_at"], None)]
+    if name == "snapshot.json":
+        return [("snapshot", [
+            "root_account_id", "account_id", "institution_name",
+            "institution_account_name", "institution_account_number",
+            "group", "balance"
+        ], ["account_id"], list(snapshot_rows(data)), None, None)]
+    if name == "account_balances.json":
+        return [_by_month("account_balances",
+                          ["account_id", "month", "balance", "balance_in_base"],
+                          ["account_id", "month"],
+                          list(account_balance_rows(data)))]
+    if name == "net_worth.json":
+        columns = ["month", "net_worth", "net_worth_in_base"]
+        return [_by_month("net_worth", columns, ["month"],
+                          list(_records(data["net_worth"], columns))),
+                _by_month("net_worth_by_types",
+                          ["type", "month", "balance", "balance_in_base"],
+                          ["type", "month"],
+                          list(net_worth_by_type_rows(data)))]
+    if name == "cashflow.json":
+        columns = ["month", "amount_in", "amount_out", "amount_total"]
+        return [_by_month("cash_flow", columns, ["month"],
+                          list(_records(data["cash_flow"], columns)))]
+    if name.startswith("spending-"):
+        month = name[len("spending-"):-len(".json")]
+        return [("spendings", ["month", "category", "value"],
+                 ["month", "category"], list(spending_rows(month, data)),
+                 None, ("month", [month])),
+                ("spendings_by_month", ["month", "amount"], ["month"],
+                 list(spending_total_rows(month, data)), None,
+                 ("month", [month]))]
+    if name.startswith("transactions-"):
+        month = name[len("transactions-"):-len(".json")]
+        return [("transactions", ["month"] + TRANSACTION_COLUMNS, ["id"],
+                 list(transaction_rows(month, data)),
+                 ["updated_at", "month"],
+                 ("month", [month]))]
+    return []
+
+
+def _load_file(conn: sqlite3.Connection, name: str, data) -> int:
+    """raw JSON 1ファイル分を対応するテーブルへ取り込む"""
+    return sum(replace(conn, *s) for s in statements(name, data))
+
+
+def mark_loaded(conn: sqlite3.Connection, name: str, digest: str):
+    """`name`をsha256が`digest`の内容で取り込んだと記録する"""
+    upsert(conn, "loaded_files", ["name", "sha256"], ["name"],
+           [(name, digest)])
+
+
+def load_changed(conn: sqlite3.Connection, data_dir: str) -> int:
+    """data_dirのJSONのうち、前回の取り込みから変わったものだけをDBへ反映する。
+    変更のあった行数を返す。"""
+    loaded = dict(conn.execute("SELECT name, sha256 FROM loaded_files"))
+    changes = 0
+    with conn:
+        for path, name, digest in rawstore.changed(data_dir, "*.json",
+                                                   loaded):
+            changes += _load_file(conn, name, rawstore.load(path))
+            mark_loaded(conn, name, digest)
+    return changes
+
+
+def load(data_dir: str, db_path: str) -> int:
+    """`load_changed`をdb_pathのDBに対して行う"""
+    conn = connect(db_path)
+    try:
+        return load_changed(conn, data_dir)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: load_db.py raw_dir moneytree.db")
+    print(f"{load(sys.argv[1], sys.argv[2])} row(s) changed")
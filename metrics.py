@@ -0,0 +1,173 @@
+"""リクエストごとの計測と実行結果のメトリクス
+
+`Moneytree.hooks`に登録した関数は、リクエストごとに`RequestEvent`を、
+レスポンスのJSONをパースするたびに`ParseEvent`を受け取ります。
+`RunMetrics`はそれを集計してJSONとPrometheusのtextfile形式で書き出します。
+
+# Usage
+
+```python
+metrics = RunMetrics()
+mt = Moneytree(token)
+mt.hooks.append(metrics)
+...
+metrics.write_json("metrics.json")
+metrics.write_prometheus("/var/lib/node_exporter/moneytree.prom")
+```
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+@dataclass
+class RequestEvent:
+    endpoint: str
+    status: Optional[int]
+    seconds: float
+    bytes: int
+    retries: int
+    error: Optional[str] = None
+
+
+@dataclass
+class ParseEvent:
+    endpoint: str
+    seconds: float
+
+
+@dataclass
+class EndpointStats:
+    requests: int = 0
+    errors: int = 0
+    bytes: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    parse_seconds: float = 0.0
+    statuses: dict = field(default_factory=dict)
+    buckets: list = field(default_factory=lambda: [0] * (len(BUCKETS) + 1))
+
+    def add(self, event: RequestEvent):
+        self.requests += 1
+        self.bytes += event.bytes
+        self.retries += event.retries
+        self.seconds += event.seconds
+        self.max_seconds = max(self.max_seconds, event.seconds)
+        if event.status is None or event.status >= 400:
+            self.errors += 1
+        status = str(event.status or "error")
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.buckets[bisect.bisect_left(BUCKETS, event.seconds)] += 1
+
+
+class RunMetrics:
+    """hookとして登録して、1回の実行分のメトリクスを集める"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.endpoints = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            stats = self.endpoints.setdefault(event.endpoint, EndpointStats())
+            if isinstance(event, ParseEvent):
+                stats.parse_seconds += event.seconds
+            else:
+                stats.add(event)
+
+    def count(self, name: str, value: int = 1):
+        """ファイル数や失敗数など、実行全体のカウンタを足す"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def summary(self) -> dict:
+        with self._lock:
+            finished_at = self.finished_at or time.time()
+            return {
+                "started_at": self.started_at,
+                "duration_seconds": finished_at - self.started_at,
+                "counters": dict(self.counters),
+                "endpoints": {
+                    name: {
+                        "requests": s.requests,
+                        "errors": s.errors,
+                        "retries": s.retries,
+                        "bytes": s.bytes,
+                        "seconds": s.seconds,
+                        "avg_seconds": s.seconds / s.requests
+                        if s.requests else 0.0,
+                        "max_seconds": s.max_seconds,
+                        "parse_seconds": s.parse_seconds,
+                        "statuses": dict(s.statuses),
+                        "latency_buckets": dict(
+                            zip([str(b) for b in BUCKETS] + ["+Inf"],
+                                s.buckets)),
+                    }
+                    for name, s in sorted(self.endpoints.items())
+                },
+            }
+
+    def write_json(self, path: str):
+        _write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def prometheus(self) -> str:
+        """Prometheusのtextfile形式"""
+        summary = self.summary()
+        lines = [
+            "# TYPE moneytree_run_duration_seconds gauge",
+            f"moneytree_run_duration_seconds {summary['duration_seconds']}",
+            "# TYPE moneytree_run_timestamp_seconds gauge",
+            f"moneytree_run_timestamp_seconds {summary['started_at']}",
+        ]
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"# TYPE moneytree_run_{name} gauge")
+            lines.append(f"moneytree_run_{name} {value}")
+
+        lines.append("# TYPE moneytree_request_duration_seconds histogram")
+        for name, s in summary["endpoints"].items():
+            cumulative = 0
+            for le, n in s["latency_buckets"].items():
+                cumulative += n
+                lines.append('moneytree_request_duration_seconds_bucket'
+                             f'{{endpoint="{name}",le="{le}"}} {cumulative}')
+            lines.append('moneytree_request_duration_seconds_sum'
+                         f'{{endpoint="{name}"}} {s["seconds"]}')
+            lines.append('moneytree_request_duration_seconds_count'
+                         f'{{endpoint="{name}"}} {s["requests"]}')
+        for metric, key in [("response_bytes", "bytes"),
+                            ("retries", "retries"),
+                            ("parse_seconds", "parse_seconds")]:
+            lines.append(f"# TYPE moneytree_{metric}_total counter")
+            for name, s in summary["endpoints"].items():
+                lines.append(f'moneytree_{metric}_total{{endpoint="{name}"}} '
+                             f'{s[key]}')
+        lines.append("# TYPE moneytree_responses_total counter")
+        for name, s in summary["endpoints"].items():
+            for status, n in sorted(s["statuses"].items()):
+                lines.append('moneytree_responses_total'
+                             f'{{endpoint="{name}",status="{status}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        _write_atomic(path, self.prometheus())
+
+
+def _write_atomic(path: str, text: str):
+    """node_exporterが書きかけを読まないよう、一時ファイルからrenameする"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
@@ -0,0 +1,423 @@
+#!/usr/bin/python
+"""Moneytree APIのローカル代替サーバ
+
+`API`の全エンドポイントを、合成したデータまたは
+download()で保存したJSON(録画データ)から返します。
+ネットワークや本物のアカウントなしで Moneytree / download() / convert を動かせます。
+
+# Usage
+
+```
+python3 mock_server.py --port 8080 --accounts 5 --months 18 --transactions 300
+python3 mock_server.py --port 8080 --fixtures data/raw
+```
+
+```python
+from mock_server import MockServer
+with MockServer(accounts=5, months=18) as server:
+    Moneytree.origin = server.origin
+    download(folder, "dummy", 18)
+    print(server.request_count)
+```
+"""
+import argparse
+import calendar
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+from dateutil.relativedelta import relativedelta
+
+import rawstore
+from moneytree_scraping import API
+
+PREFIX = "/v8/api"
+MERCHANTS = [
+    "セブンイレブン", "ファミリーマート", "ローソン", "スターバックス", "AMAZON.CO.JP",
+    "JR東日本", "東京電力", "東京ガス", "楽天市場", "ヨドバシカメラ", "マツモトキヨシ",
+    "イオン", "ユニクロ", "NETFLIX", "APPLE.COM/BILL"
+]
+
+
+def _month(value: str) -> date:
+    """YYYY-MM-DD または MM/DD/YYYY の月初"""
+    if "/" in value:
+        m, _, y = value.split("/")
+    else:
+        y, m, _ = value.split("-")
+    return date(int(y), int(m), 1)
+
+
+class StatusError(Exception):
+    """`handle`から投げると、そのステータスで応答する"""
+
+    def __init__(self, status: int):
+        super().__init__(status)
+        self.status = status
+
+
+class SyntheticData:
+    """乱数で作るフィクスチャ。月ごとのデータはseedから都度生成するので、
+    大きな規模でもメモリに全部は載せません。"""
+
+    def __init__(self,
+                 accounts: int = 5,
+                 categories: int = 30,
+                 months: int = 18,
+                 transactions: int = 200,
+                 seed: int = 0):
+        self.n_accounts = accounts
+        self.n_categories = categories
+        self.n_months = months
+        self.n_transactions = transactions
+        self.seed = seed
+        today = date.today().replace(day=1)
+        self.months = [today - relativedelta(months=i) for i in range(months)]
+
+    def accounts(self):
+        return [{
+            "id": 1000000 + i,
+            "guest_id": 1,
+            "nickname": f"口座{i}",
+            "currency": "JPY",
+            "credential_id": 500 + i // 3,
+            "account_type": "bank" if i % 2 == 0 else "credit_card",
+            "institution_account_number": f"{i:07d}",
+            "institution_account_name": "普通",
+            "branch_name": None,
+            "status": "normal",
+            "last_success_at": "2024-01-01T00:00:00Z",
+            "group": "personal",
+            "detail_type": "bank",
+            "sub_type": "savings",
+            "current_balance": 100000.0 * (i + 1),
+            "current_balance_in_base": 100000.0 * (i + 1),
+            "current_unclosed_balance": 0.0,
+            "current_closed_balance": None,
+            "current_revolving_balance": 0.0,
+        } for i in range(self.n_accounts)]
+
+    def categories(self):
+        return [{
+            "id": i + 1,
+            "parent_id": (i // 5) * 5 + 1 if i % 5 else None,
+            "guest_id": 1,
+            "category_type": "expense",
+            "updated_at": "2024-01-01T00:00:00Z",
+            "created_at": "2024-01-01T00:00:00Z",
+            "entity_key": None,
+            "name": f"カテゴリ{i + 1}",
+            "icon_key": "misc",
+            "parent": {"id": (i // 5) * 5 + 1},
+            "guest": {"id": 1},
+        } for i in range(self.n_categories)]
+
+    def transactions(self, month: date):
+        """その月の全トランザクション"""
+        if month not in self.months:
+            return []
+        index = self.months.index(month)
+        rnd = random.Random(self.seed * 100003 + index)
+        last_day = calendar.monthrange(month.year, month.month)[1]
+        stamp = f"{month.isoformat()}T00:00:00Z"
+        result = []
+        for j in range(self.n_transactions):
+            day = month.replace(day=rnd.randint(1, last_day)).isoformat()
+            merchant = rnd.choice(MERCHANTS)
+            result.append({
+                "id": (self.seed + 1) * 10**9 + index * 10**6 + j,
+                "amount": -float(rnd.randint(100, 20000)),
+                "date": day,
+                "description_guest": None,
+                "description_pretty": merchant,
+                "description_raw": f"{merchant} {rnd.randint(1, 999):03d}",
+                "raw_transaction_id": index * 10**6 + j,
+                "created_at": stamp,
+                "updated_at": stamp,
+                "expense_type": 0,
+                "predicted_expense_type": 0,
+                "category_id": rnd.randint(1, self.n_categories),
+                "account_id": 1000000 + rnd.randrange(self.n_accounts),
+                "claim_id": None,
+                "attachments": [],
+                "receipts": [],
+                "attributes": {},
+            })
+        result.sort(key=lambda t: t["date"], reverse=True)
+        return result
+
+    def category_totals(self, month: date) -> dict:
+        categories = {}
+        for t in self.transactions(month):
+            key = str(t["category_id"])
+            categories[key] = categories.get(key, 0.0) + t["amount"]
+        return categories
+
+    def account_balances(self, account_ids):
+        return [{
+            "account_id": str(account_id),
+            "account_type": "bank",
+            "currency": "JPY",
+            "years": sorted({m.year for m in self.months}),
+            "monthly_balances": [{
+                "month": m.strftime("%Y-%m"),
+                "balance": float(account_id % 1000 * 1000 + i),
+                "balance_in_base": None,
+            } for i, m in enumerate(reversed(self.months))],
+        } for account_id in account_ids]
+
+    def snapshot(self):
+        credentials = {}
+        for a in self.accounts():
+            credential = credentials.setdefault(a["credential_id"], {
+                "id": a["credential_id"],
+                "institution_name": f"銀行{a['credential_id']}",
+                "status": "success",
+                "accounts": [],
+            })
+            credential["accounts"].append(a)
+        return {"guest": {"id": 1, "credentials": list(credentials.values())}}
+
+    def net_worth(self):
+        rows = [{
+            "month": m.strftime("%Y-%m"),
+            "net_worth": 1000000 + i,
+            "net_worth_in_base": 1000000 + i,
+        } for i, m in enumerate(reversed(self.months))]
+        return {
+            "net_worth": rows,
+            "account_type_balances": {
+                t: rows for t in
+                ["bank", "credit_card", "stored_value", "manual", "stock"]
+            },
+        }
+
+    def cash_flow(self):
+        rows = []
+        for m in reversed(self.months):
+            totals = self.category_totals(m)
+            amount_out = sum(totals.values())
+            rows.append({
+                "month": m.strftime("%Y-%m"),
+                "amount_in": 300000.0,
+                "amount_out": amount_out,
+                "amount_total": 300000.0 + amount_out,
+                "categories": totals,
+            })
+        return {"cash_flow": rows}
+
+    def handle(self, api: API, params: dict):
+        """エンドポイントごとのレスポンス(JSONにできるオブジェクト)"""
+        if api == API.ACCOUNT:
+            return {"accounts": self.accounts()}
+        if api == API.CATEGORY:
+            return {"categories": self.categories()}
+        if api == API.SNAPSHOT:
+            return self.snapshot()
+        if api == API.NET_WORTH:
+            return self.net_worth()
+        if api == API.CASHFLOW:
+            return self.cash_flow()
+        if api == API.ACCOUNT_BALANCES:
+            ids = [int(i) for i in params.get("account_ids[]", [])]
+            return {"account_balances": self.account_balances(ids)}
+        start = _month(params["start_date"][0])
+        end = _month(params["end_date"][0])
+        if api == API.SPENDING:
+            totals = []
+            month = start
+            while month <= end:
+                categories = self.category_totals(month)
+                totals.append({
+                    "start_date": month.isoformat(),
+                    "end_date": (month + relativedelta(months=1, days=-1)
+                                 ).isoformat(),
+                    "total": sum(categories.values()),
+                    "categories": categories,
+                })
+                month += relativedelta(months=1)
+            return {
+                "start_date": params["start_date"][0],
+                "end_date": params["end_date"][0],
+                "category_totals": totals,
+            }
+        if api == API.TRANSACTIONS:
+            page = int(params.get("page", ["1"])[0])
+            per_page = int(params.get("per_page", ["500"])[0])
+            rows = []
+            month = start
+            while month <= end:
+                rows.extend(self.transactions(month))
+                month += relativedelta(months=1)
+            return {
+                "transactions": rows[(page - 1) * per_page:page * per_page],
+                "transactions_details": {
+                    "page": page,
+                    "per_page": per_page,
+                    "start_date": params["start_date"][0],
+                    "end_date": params["end_date"][0],
+                },
+            }
+        raise KeyError(api)
+
+
+class RecordedData:
+    """download()で保存したフォルダを元に返すフィクスチャ"""
+
+    def __init__(self, folder: str):
+        self.folder = folder
+
+    def _load(self, name: str):
+        return rawstore.load(os.path.join(self.folder, name))
+
+    def handle(self, api: API, params: dict):
+        if api in (API.SPENDING, API.TRANSACTIONS):
+            name = "%s-%s.json" % (api.name.lower(),
+                                   _month(params["start_date"][0])
+                                   .strftime("%Y-%m"))
+            if not rawstore.exists(os.path.join(self.folder, name)):
+                return {"category_totals": []} if api == API.SPENDING \
+                    else {"transactions": []}
+            data = self._load(name)
+            if api == API.TRANSACTIONS:
+                page = int(params.get("page", ["1"])[0])
+                per_page = int(params.get("per_page", ["500"])[0])
+                data["transactions"] = data["transactions"][
+                    (page - 1) * per_page:page * per_page]
+                data.setdefault("transactions_details", {})["page"] = page
+            return data
+        return self._load(f"{api.name.lower()}.json")
+
+
+class MockServer:
+    """スレッドで動くモックサーバ。
+
+    `latency`秒の遅延と、`error_rate`の確率での503応答を注入できます。
+    `token`を指定すると、そのBearerトークン以外は401を返します。
+    """
+
+    def __init__(self,
+                 data: Optional[SyntheticData] = None,
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 latency: float = 0.0,
+                 error_rate: float = 0.0,
+                 token: Optional[str] = None,
+                 **synthetic):
+        self.data = data or SyntheticData(**synthetic)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.token = token
+        self.request_count = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        self._routes = {PREFIX + api.value: api for api in API}
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def origin(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{PREFIX}"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                with server._lock:
+                    server.request_count += 1
+                    fail = server._random.random() < server.error_rate
+                if server.latency:
+                    time.sleep(server.latency)
+                api = server._routes.get(url.path)
+                if api is None:
+                    return self._send(404, {"error": "not found"})
+                authorization = self.headers.get("Authorization", "")
+                if not re.match(r"Bearer \S+", authorization) or (
+                        server.token
+                        and authorization != f"Bearer {server.token}"):
+                    return self._send(401, {"error": "unauthorized"})
+                if fail:
+                    return self._send(503, {"error": "injected"})
+                params = parse_qs(url.query)
+                try:
+                    return self._send(200, server.data.handle(api, params))
+                except StatusError as e:
+                    return self._send(e.status, {"error": "injected"})
+                except (KeyError, ValueError) as e:
+                    return self._send(400, {"error": str(e)})
+
+            def _send(self, status: int, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                with server._lock:
+                    server.bytes_sent += len(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Moneytree mock API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--fixtures", help="download()で保存したフォルダ")
+    parser.add_argument("--accounts", type=int, default=5)
+    parser.add_argument("--categories", type=int, default=30)
+    parser.add_argument("--months", type=int, default=18)
+    parser.add_argument("--transactions", type=int, default=200,
+                        help="1ヶ月あたりのトランザクション数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="1リクエストあたりの遅延(秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="503を返す確率")
+    args = parser.parse_args()
+
+    if args.fixtures:
+        data = RecordedData(args.fixtures)
+    else:
+        data = SyntheticData(args.accounts, args.categories, args.months,
+                             args.transactions, args.seed)
+    server = MockServer(data, args.host, args.port, args.latency,
+                        args.error_rate)
+    print(f"serving on {server.origin}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
@@ -48,15 +48,38 @@ print(json.dumps(account_balances, indent=4, ensure_ascii=False))
 * /transactions.json: 明細
 * /data_snapshot.json: アカウントのサブスクタイプや最後の口座情報が乗っている
 """
+from __future__ import annotations
+
+import argparse
+import hashlib
 import json
+import os
+import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from functools import lru_cache
 from types import SimpleNamespace
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Optional
 from enum import Enum
-import requests
 import calendar
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
+import rawstore
+from metrics import ParseEvent, RequestEvent, RunMetrics
+from ratelimit import THROTTLE_STATUSES, RateLimiter, retry_after
+from records import Account, Category
+
+if TYPE_CHECKING:
+    import requests
+
+
+class AuthError(Exception):
+    """トークンが無効で、取り直しもできなかった。
+
+    以降のリクエストもすべて失敗するので、download()はここで止める。
+    """
 
 
 class API(Enum):
@@ -400,51 +423,262 @@ class API(Enum):
     # """
 
 
-class Response(requests.Response):
-    """Custom Response Class
+@lru_cache(maxsize=None)
+def _response_class():
+    """requestsは重いので、最初のリクエストまでimportしない"""
+    import requests
 
-    # Usage:
-        resp = requests.get(url=self.origin + api.value,
-                            headers=self._header,
-                            timeout=400,
-                            params=params)
-        custom_resp = Response()
-        custom_resp.__dict__.update(resp.__dict__)
-    """
+    class Response(requests.Response):
+        """Custom Response Class
 
-    def __init__(self, resp: requests.Response):
-        super().__init__()
-        self.__dict__.update(resp.__dict__)
+        # Usage:
+            resp = self.session.get(url=self.origin + api.value,
+                                    timeout=self.timeout,
+                                    params=params)
+            custom_resp = Response()
+            custom_resp.__dict__.update(resp.__dict__)
+        """
 
-    def indented_json(self):
-        """tab indent JSON"""
-        return json.dumps(self.json(), indent=4, ensure_ascii=False)
+        def __init__(self, resp: requests.Response, endpoint: str = "", hooks=()):
+            super().__init__()
+            self.__dict__.update(resp.__dict__)
+            self.endpoint = endpoint
+            self.hooks = hooks
+
+        def json(self, **kwargs):
+            """パースにかかった時間をhookへ通知する"""
+            start = time.perf_counter()
+            data = super().json(**kwargs)
+            event = ParseEvent(self.endpoint, time.perf_counter() - start)
+            for hook in self.hooks:
+                hook(event)
+            return data
+
+        def indented_json(self):
+            """tab indent JSON"""
+            return json.dumps(self.json(), indent=4, ensure_ascii=False)
+
+        def object(self):
+            """property accessable object"""
+            return self.json(object_hook=lambda x: SimpleNamespace(**x))
+
+        def records(self, record_type):
+            """`records`モジュールの型付きレコードのリスト
+            usage:
+                resp.records(records.Transaction)
+            """
+            return record_type.from_json(
+                self.json(object_hook=record_type.object_hook()))
+
+    return Response
+
+
+def __getattr__(name):
+    # from moneytree_scraping import Response のためのモジュールの__getattr__
+    if name == "Response":
+        return _response_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class ReferenceCache:
+    """カテゴリ・口座のような参照テーブルのキャッシュ
+
+    レスポンスのJSONを`ttl`秒の間メモリに保持します。
+    `path`を指定するとディスクにも保存し、別プロセスからも再利用します。
+    ディスクのキャッシュはトークン(ゲスト)ごとに別のフォルダを指定してください。
+    """
 
-    def object(self):
-        """property accessable object"""
-        return self.json(object_hook=lambda x: SimpleNamespace(**x))
+    def __init__(self, ttl: float = 3600, path: Optional[str] = None):
+        self.ttl = ttl
+        self.path = path
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    def _file(self, api: API) -> str:
+        return os.path.join(self.path, f"{api.name.lower()}.json")
+
+    def get(self, api: API):
+        """有効期限内のキャッシュがあれば返す。なければNone"""
+        now = time.time()
+        with self._lock:
+            if api in self._memory:
+                stored_at, data = self._memory[api]
+                if now - stored_at < self.ttl:
+                    return data
+            if self.path is None:
+                return None
+            try:
+                stored_at = os.path.getmtime(self._file(api))
+                if now - stored_at >= self.ttl:
+                    return None
+                with open(self._file(api), encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self._memory[api] = (stored_at, data)
+            return data
+
+    def set(self, api: API, data):
+        with self._lock:
+            self._memory[api] = (time.time(), data)
+            if self.path is not None:
+                os.makedirs(self.path, exist_ok=True)
+                with open(self._file(api), "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+
+    def invalidate(self, api: Optional[API] = None):
+        """`api`(省略時はすべて)のキャッシュを捨てる"""
+        with self._lock:
+            for key in [api] if api else list(API):
+                self._memory.pop(key, None)
+                if self.path is not None:
+                    try:
+                        os.remove(self._file(key))
+                    except FileNotFoundError:
+                        pass
 
 
 class Moneytree:
-    """Moneytree API"""
-    origin = "https://jp-api.getmoneytree.com/v8/api"
-    _header = {"Content-Type": "application/json"}
+    """Moneytree API
 
-    def __init__(self, token: Optional[str] = None):
+    接続は`requests.Session`でプールし、keep-aliveで使い回します。
+    5xxや接続エラーは`retries`回まで指数バックオフでリトライします。
+    すべてのリクエストは`rate_limiter`を通り、429/503のときは
+    Retry-Afterに従って`throttle_retries`回まで待ってやり直します。
+    """
+    origin = "https://jp-api.getmoneytree.com/v8/api"
+    timeout = 400
+
+    def __init__(self,
+                 token: Optional[str] = None,
+                 pool_size: int = 10,
+                 retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 cache: Optional[ReferenceCache] = None,
+                 token_refresher: Optional[Callable[[str], str]] = None,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 throttle_retries: int = 5,
+                 concurrency=None):
         if token is None:
             token = input("Input Bearer token (Without 'Bearer ' string): ")\
                 .replace("\n", "").replace("Bearer ", "")  # 不要な文字列削除
-        Moneytree._header.update({"Authorization": f"Bearer {token}"})
-        self.categories = self.get(API.CATEGORY).object().categories
-        self.category_table = {c.id: c.name for c in self.categories}
-        self.accounts = self.get(API.ACCOUNT).object().accounts
-        self.account_table = {a.id: a.nickname for a in self.accounts}
+        self.token = token
+        self._header = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}",
+        }
+        # 401のとき、期限切れのトークンを受け取って新しいトークンを返す関数
+        # (token_manager.TokenManager.refresh など)
+        self.token_refresher = token_refresher
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.throttle_retries = throttle_retries
+        # 同時に送るリクエスト数を抑えるセマフォ。プロセス間で共有してもよい
+        self.concurrency = concurrency
+        # セッション(とrequestsのimport)は最初のリクエストまで作らない
+        self._session_options = (pool_size, retries, backoff_factor)
+        self._session = None
+        self._session_lock = threading.Lock()
+        # リクエストごとに metrics.RequestEvent / ParseEvent を受け取る関数
+        self.hooks = []
+        # カテゴリ・口座は初めて使われたときに取得する
+        self.cache = cache or ReferenceCache()
+        self._reference_lock = threading.Lock()
+
+    def reference(self, api: API):
+        """参照テーブル(API.CATEGORY, API.ACCOUNT)のJSON。
+        キャッシュになければ取得してキャッシュする。"""
+        data = self.cache.get(api)
+        if data is None:
+            with self._reference_lock:
+                data = self.cache.get(api)
+                if data is None:
+                    data = self.get(api).json()
+                    self.cache.set(api, data)
+        return data
+
+    @property
+    def categories(self):
+        return Category.from_json(self.reference(API.CATEGORY))
+
+    @property
+    def category_table(self) -> dict:
+        """{カテゴリID: カテゴリ名}"""
+        return {
+            c["id"]: c["name"]
+            for c in self.reference(API.CATEGORY)["categories"]
+        }
+
+    @property
+    def accounts(self):
+        return Account.from_json(self.reference(API.ACCOUNT))
+
+    @property
+    def account_table(self) -> dict:
+        """{口座ID: ニックネーム}"""
+        return {
+            a["id"]: a["nickname"]
+            for a in self.reference(API.ACCOUNT)["accounts"]
+        }
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._new_session(*self._session_options)
+        return self._session
+
+    def _new_session(self, pool_size: int, retries: int,
+                     backoff_factor: float) -> requests.Session:
+        """keep-aliveとリトライ設定済みのセッションを作成します。"""
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(total=retries,
+                      connect=retries,
+                      read=retries,
+                      status=retries,
+                      backoff_factor=backoff_factor,
+                      # 429/503はここでは再試行せず、_sendからrate_limiterへ渡す。
+                      # Retry-Afterに従うとurllib3がこのスレッドだけで待つので無効にする
+                      status_forcelist=(500, 502, 504),
+                      respect_retry_after_header=False,
+                      allowed_methods=frozenset(["GET"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.headers.update(self._header)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def set_token(self, token: str):
+        """Bearerトークンを差し替えます。"""
+        self.token = token
+        self._header["Authorization"] = f"Bearer {token}"
+        if self._session is not None:
+            self._session.headers.update(self._header)
+
+    def close(self):
+        """プールしている接続を閉じます。"""
+        if self._session is not None:
+            self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def get(self,
             api: API,
             group_by="monthly_period",
             per_page=500,
-            **params) -> Response:
+            stream: bool = False,
+            **params) -> requests.Response:
         """get data from moneytree API"""
         # REQUIRE params
         if api == API.SPENDING:
@@ -478,24 +712,189 @@ class Moneytree:
         elif api == API.ACCOUNT_BALANCES:
             # アカウントIDは口座一つ一つに対応する7桁くらいの数字
             # account_ids はアカウントIDのリスト
-            accounts_keys = [a.id for a in self.accounts]
-            params.update({"account_ids[]": accounts_keys})
+            # 指定がなければすべての口座
+            if "account_ids[]" not in params:
+                accounts_keys = [
+                    a["id"] for a in self.reference(API.ACCOUNT)["accounts"]
+                ]
+                params.update({"account_ids[]": accounts_keys})
 
         # GET data from moneytree API
-        resp = requests.get(url=self.origin + api.value,
-                            headers=self._header,
-                            timeout=400,
-                            params=params)
+        token = self.token
+        resp = self._send(api, params, stream)
+        if resp.status_code == 401 and self.token_refresher is not None:
+            # トークンを取り直して1回だけやり直す
+            resp.close()
+            try:
+                token = self.token_refresher(token)
+            except Exception as e:
+                raise AuthError(f"トークンを取り直せませんでした: {e}") from e
+            self.set_token(token)
+            resp = self._send(api, params, stream)
         if resp.status_code == 401:
-            raise requests.HTTPError("tokenの有効期限が切れました。Bearerトークンを再設定してください。")
+            resp.close()
+            raise AuthError("tokenの有効期限が切れました。Bearerトークンを再設定してください。")
         resp.raise_for_status()
         # if prop_access:
         #     return resp.json(object_hook=lambda x: SimpleNamespace(**x))
 
         # success response
-        custom_resp = Response(resp)
+        custom_resp = _response_class()(resp, api.name, self.hooks)
         return custom_resp
 
+    def _send(self, api: API, params: dict, stream: bool) -> requests.Response:
+        """レート制限に従ってリクエストを送り、計測結果をhookへ通知する"""
+        import requests
+
+        for attempt in range(self.throttle_retries + 1):
+            self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                if self.concurrency is None:
+                    resp = self._request(api, params, stream)
+                else:
+                    with self.concurrency:
+                        resp = self._request(api, params, stream)
+            except requests.RequestException as e:
+                self._emit(RequestEvent(api.name, None,
+                                        time.perf_counter() - start, 0, 0,
+                                        type(e).__name__))
+                raise
+            self._emit(RequestEvent(
+                api.name, resp.status_code, time.perf_counter() - start,
+                int(resp.headers.get("Content-Length", 0))
+                if stream else len(resp.content),
+                len(getattr(getattr(resp.raw, "retries", None), "history",
+                            ()))))
+            if (resp.status_code not in THROTTLE_STATUSES
+                    or attempt == self.throttle_retries):
+                break
+            resp.close()
+            self.rate_limiter.throttle(
+                attempt, retry_after(resp.headers.get("Retry-After")))
+        return resp
+
+    def _request(self, api: API, params: dict,
+                 stream: bool) -> requests.Response:
+        return self.session.get(url=self.origin + api.value,
+                                timeout=self.timeout,
+                                params=params,
+                                stream=stream)
+
+    def _emit(self, event):
+        for hook in self.hooks:
+            hook(event)
+
+    def get_account_balances(self,
+                             batch_size: int = 20,
+                             workers: int = 4,
+                             start_month: Optional[str] = None,
+                             end_month: Optional[str] = None) -> dict:
+        """口座を`batch_size`件ずつに分けてAPI.ACCOUNT_BALANCESを並行に取得し、
+        1回で取得したときと同じ形 {"account_balances": [...]} にまとめる。
+        `batch_size`が0なら全口座を1回で取得する。
+
+        start_month, end_month (YYYY-MM) を指定すると、
+        monthly_balancesをその範囲の月だけに絞る。APIには期間を指定する
+        パラメータがないので、絞るのは受け取った後で、転送量は変わらない
+        (保存するファイルとメモリが小さくなるだけ)。
+        usage:
+            mt = Moneytree(token)
+            balances = mt.get_account_balances(batch_size=10,
+                                               start_month="2023-01")
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        ids = [a["id"] for a in self.reference(API.ACCOUNT)["accounts"]]
+        batch_size = batch_size or max(1, len(ids))
+        batches = [
+            ids[i:i + batch_size] for i in range(0, len(ids), batch_size)
+        ]
+
+        def fetch(batch):
+            return self.get(API.ACCOUNT_BALANCES,
+                            **{"account_ids[]": batch}).json()
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(fetch, batches))
+
+        balances = [b for r in results for b in r["account_balances"]]
+        if start_month or end_month:
+            for b in balances:
+                b["monthly_balances"] = [
+                    m for m in b["monthly_balances"]
+                    if (start_month or "") <= m["month"][:7] <= (
+                        end_month or "9999-99")
+                ]
+        data = dict(results[0]) if results else {}
+        data["account_balances"] = balances
+        return data
+
+    def iter_transaction_pages(self,
+                               start_date: str,
+                               end_date: str,
+                               per_page: int = 500):
+        """API.TRANSACTIONSを1ページ目から順に取得し、ページごとのJSONを返す。
+
+        per_pageは500が上限(それより大きいと400エラー)なので、
+        件数がper_pageに達している間は次のページを取りに行く。
+        ページが空のとき、または前のページと同じ取引が返ってきたとき
+        (`page`を無視された場合)も終わりとみなす。
+        呼び出し側が今のページを処理している間に次のページを先読みします。
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def fetch(page):
+            return self.get(API.TRANSACTIONS,
+                            per_page=per_page,
+                            start_date=start_date,
+                            end_date=end_date,
+                            page=page).json()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            page = 1
+            previous = None
+            future = executor.submit(fetch, page)
+            while future is not None:
+                data = future.result()
+                transactions = data.get("transactions", [])
+                ids = [t.get("id") for t in transactions]
+                if page > 1 and (not transactions or ids == previous):
+                    break
+                previous = ids
+                if len(transactions) >= per_page:
+                    page += 1
+                    future = executor.submit(fetch, page)
+                else:
+                    future = None
+                yield data
+
+    def iter_transactions(self,
+                          start_date: str,
+                          end_date: str,
+                          per_page: int = 500):
+        """期間内のトランザクションを1件ずつ返すジェネレータ。
+        usage:
+            mt = Moneytree(token)
+            for t in mt.iter_transactions("2023-06-01", "2023-06-30"):
+                print(t["date"], t["amount"], t["description_pretty"])
+        """
+        for data in self.iter_transaction_pages(start_date, end_date,
+                                                per_page):
+            yield from data.get("transactions", [])
+
+    def spending_matrix(self, start_date: str, end_date: str):
+        """期間の支出を月 x カテゴリの`SpendingMatrix`で返す。
+        usage:
+            matrix = mt.spending_matrix("2023-01-01", "2023-12-31")
+            matrix.rollup_parents().totals_by_category()
+        """
+        from spending_matrix import SpendingMatrix
+        spending = self.get(API.SPENDING, start_date=start_date,
+                            end_date=end_date).json()
+        return SpendingMatrix.from_spending(
+            spending, categories=self.reference(API.CATEGORY)["categories"])
+
     def rename_category(self, spending):
         """get_spending()で取得できるJSONのcategory idをnameに変換します。
         usage:
@@ -512,23 +911,327 @@ class Moneytree:
 
         そのためにはSpengingクラスを作るか。
         """
+        category_table = self.category_table
         for i, cat in enumerate(spending["category_totals"]):
             # 支出IDと支出名称の置換を
             # spending["category_totals"]配列に対して行う
             # パット見何をやっているか理解に苦しむ
             new_category = {
-                self.category_table[int(k)]: v
+                category_table[int(k)]: v
                 for k, v in cat["categories"].items()
             }
             spending["category_totals"][i] = new_category
         return spending
 
 
-def download(folder: str, token: str, months: int):
-    """APIに登録されているキーをすべて実行して、
-    `API.name`.json というファイル名で保存する。
+def month_ranges(months: int):
+    """今月から遡って`months`ヶ月分の (year, month, start_date, end_date) を返す。"""
+    from dateutil.relativedelta import relativedelta
+
+    current_date = datetime.now()
+    for i in range(months):
+        month_date = current_date - relativedelta(months=i)
+        year = month_date.year
+        month = month_date.month
+        last_day = calendar.monthrange(year, month)[1]
+
+        start_date = '%4d-%02d-01' % (year, month)
+        end_date = '%4d-%02d-%2d' % (year, month, last_day)
+        yield year, month, start_date, end_date
+
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 8 * 1024 * 1024
+_UPDATED_AT = re.compile(rb'"updated_at":\s*"([^"]+)"')
+
+
+class Manifest:
+    """保存済みファイルの台帳。
+
+    ファイルごとに取得日時、内容のハッシュ、最大の`updated_at`を
+    保存先フォルダのmanifest.jsonに記録します。
+    内容が変わっていないファイルは書き直しません。
     """
-    mt = Moneytree(token)
+    filename = rawstore.MANIFEST
+
+    def __init__(self, folder: str):
+        self.path = os.path.join(folder, self.filename)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.files = json.load(f)["files"]
+        except FileNotFoundError:
+            self.files = {}
+
+    def has(self, filename: str) -> bool:
+        """台帳に記録があり、ファイルも残っているか"""
+        return (os.path.basename(filename) in self.files
+                and rawstore.exists(filename))
+
+    def write(self, filename: str, data, compression=None) -> bool:
+        """dataを保存する。内容が変わっていなければ書き込まずFalseを返す。
+
+        dataはJSONにできるオブジェクト、またはstream=Trueで取得したResponse。
+        Responseはパースせず、本文をチャンクごとにそのまま保存する。
+        `compression`("gzip", "zstd")を指定すると圧縮して保存する。
+        """
+        streamed = hasattr(data, "iter_content")
+        if streamed:
+            chunks = data.iter_content(CHUNK_SIZE)
+            updated_at = []
+        else:
+            chunks = [json.dumps(data).encode()]
+            updated_at = [_max_updated_at(data)]
+        sha256 = hashlib.sha256()
+        tail = b""
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            for chunk in chunks:
+                sha256.update(chunk)
+                spool.write(chunk)
+                if streamed:
+                    # チャンクの境目にかかる値も拾えるよう前のチャンクの末尾をつなげる
+                    updated_at.extend(m.decode() for m in
+                                      _UPDATED_AT.findall(tail + chunk))
+                    tail = chunk[-64:]
+            digest = sha256.hexdigest()
+            key = os.path.basename(filename)
+            # 内容が同じでも保存形式(圧縮)が違えば書き直す
+            changed = not (self.has(filename)
+                           and self.files[key]["sha256"] == digest
+                           and rawstore.resolve(filename)
+                           == filename + rawstore.SUFFIXES[compression])
+            if changed:
+                spool.seek(0)
+                with rawstore.atomic_write(filename, compression) as f:
+                    shutil.copyfileobj(spool, f)
+            # 前回ここまでに落ちて残った古い形式のファイルも消す
+            rawstore.remove_other_variants(filename, compression)
+        with self._lock:
+            self.files[key] = {
+                "fetched_at": datetime.now().isoformat(timespec="seconds"),
+                "sha256": digest,
+                "max_updated_at": max(filter(None, updated_at), default=None),
+            }
+        return changed
+
+    def save(self):
+        with self._lock:
+            with rawstore.atomic_write(self.path) as f:
+                f.write(json.dumps({"files": self.files}, indent=1,
+                                   sort_keys=True).encode())
+
+
+class Journal:
+    """実行中のdownload()で保存し終えたファイルの記録
+
+    保存するたびにjournal.jsonlへ1行追記し、すべて成功したら消します。
+    途中で落ちた場合は次回`resume=True`で、記録のあるファイルを飛ばして再開します。
+    1行目には実行の条件`run`(月数、開始月など)を書き、
+    それが今回と違う古い記録は使わずに捨てます。
+    """
+    filename = "journal.jsonl"
+
+    def __init__(self,
+                 folder: str,
+                 resume: bool = False,
+                 run: Optional[dict] = None):
+        self.path = os.path.join(folder, self.filename)
+        self._lock = threading.Lock()
+        self.done = set()
+        if resume and self._load(run or {}):
+            return
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"run": run or {}}) + "\n")
+
+    def _load(self, run: dict) -> bool:
+        """同じ条件の実行の記録を読む。使える記録がなければFalse"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return False
+        try:
+            if json.loads(lines[0])["run"] != run:
+                return False
+        except (IndexError, ValueError, KeyError):
+            return False
+        for line in lines[1:]:
+            try:
+                self.done.add(json.loads(line)["done"])
+            except (ValueError, KeyError):
+                # 書きかけの最後の行
+                pass
+        return True
+
+    def is_done(self, filenames) -> bool:
+        return all(os.path.basename(f) in self.done for f in filenames)
+
+    def record(self, filenames):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for filename in filenames:
+                    name = os.path.basename(filename)
+                    f.write(json.dumps({"done": name}) + "\n")
+                    self.done.add(name)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def finish(self):
+        """すべて成功したので記録を消す"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _max_updated_at(data) -> Optional[str]:
+    """トップレベルの配列に含まれるレコードのupdated_atの最大値"""
+    values = [
+        row["updated_at"]
+        for rows in data.values() if isinstance(rows, list)
+        for row in rows if isinstance(row, dict) and row.get("updated_at")
+    ] if isinstance(data, dict) else []
+    return max(values, default=None)
+
+
+def _fetch(mt: Moneytree,
+           item: API,
+           filename: str,
+           params: dict,
+           raw: bool = False,
+           balance_batch: int = 0,
+           workers: int = 1,
+           balance_start: Optional[str] = None) -> dict:
+    """1リクエスト分を取得して {ファイル名: JSON} で返す。
+
+    `raw`が真なら、ページングのあるTRANSACTIONSとキャッシュ済みの参照テーブル以外は
+    パースせずに本文をそのまま保存できるResponseを返す。
+    `balance_batch`が正なら、ACCOUNT_BALANCESはその口座数ずつ分けて
+    `workers`個のスレッドで取得する。`balance_start`(YYYY-MM)を渡すと、
+    ACCOUNT_BALANCESはその月以降の残高だけにする。
+    """
+    if item == API.TRANSACTIONS:
+        # 500件を超える月は複数ページをまとめて1ファイルにする
+        pages = mt.iter_transaction_pages(**params)
+        data = next(pages)
+        for page in pages:
+            data["transactions"].extend(page["transactions"])
+        return {filename: data}
+    if item in (API.ACCOUNT, API.CATEGORY):
+        return {filename: mt.reference(item)}
+    if item == API.ACCOUNT_BALANCES and (balance_batch or balance_start):
+        return {
+            filename: mt.get_account_balances(balance_batch,
+                                              workers=workers,
+                                              start_month=balance_start)
+        }
+    if raw:
+        return {filename: mt.get(item, stream=True, **params)}
+    return {filename: mt.get(item, **params).json()}
+
+
+def _store(manifest: Manifest, compression, fetch, mt: Moneytree, *args):
+    """取得して保存する。ワーカースレッドで実行する"""
+    return {
+        filename: manifest.write(filename, data, compression)
+        for filename, data in fetch(mt, *args).items()
+    }
+
+
+def month_key(value: str) -> str:
+    """YYYY-MM-DD または MM/DD/YYYY を YYYY-MM にする"""
+    if "/" in value:
+        m, _, y = value.split("/")
+        return "%04d-%02d" % (int(y), int(m))
+    return value[:7]
+
+
+def _range_too_large(error) -> bool:
+    """範囲を狭めて取り直せば通るかもしれないエラーか。
+
+    タイムアウトと400/413/5xxだけ。401/403や、待っても429/503のままだったものは
+    分けても同じなので(401ならログインを繰り返すことになる)そのまま投げる。
+    """
+    import requests
+    from urllib3.exceptions import MaxRetryError, ReadTimeoutError
+
+    if isinstance(error, requests.Timeout):
+        return True
+    # 読み込みのタイムアウトでリトライを使い切ると、requestsは
+    # ConnectionError(MaxRetryError(ReadTimeoutError)) として投げる
+    if isinstance(error, requests.ConnectionError) and error.args and \
+            isinstance(error.args[0], MaxRetryError) and \
+            isinstance(error.args[0].reason, ReadTimeoutError):
+        return True
+    status = getattr(error.response, "status_code", None)
+    if status is None or status in THROTTLE_STATUSES:
+        return False
+    return status in (400, 413) or status >= 500
+
+
+def _fetch_spending_range(mt: Moneytree, months: list) -> dict:
+    """連続した複数月のSPENDINGを1リクエストで取得し、月ごとに分割する。
+
+    monthsは (YYYY-MM, ファイル名, start_date, end_date) の古い順のリスト。
+    group_by="monthly_period"なのでcategory_totalsは月ごとに返ってくる。
+    範囲が広すぎて失敗したと思われる場合は半分に分けて取り直す。
+    """
+    import requests
+
+    start_date, end_date = months[0][2], months[-1][3]
+    try:
+        data = mt.get(API.SPENDING, start_date=start_date,
+                      end_date=end_date).json()
+    except requests.RequestException as e:
+        if len(months) == 1 or not _range_too_large(e):
+            raise
+        half = len(months) // 2
+        result = _fetch_spending_range(mt, months[:half])
+        result.update(_fetch_spending_range(mt, months[half:]))
+        return result
+
+    totals = {}
+    for total in data.get("category_totals", []):
+        totals.setdefault(month_key(total["start_date"]), []).append(total)
+    return {
+        filename: {
+            "start_date": start,
+            "end_date": end,
+            "category_totals": totals.get(key, []),
+        }
+        for key, filename, start, end in months
+    }
+
+
+def _chunks(months: list, size: int):
+    """(index, ...) のリストを、indexが連続する`size`個以下の塊に分ける"""
+    chunk = []
+    for m in months:
+        if chunk and (len(chunk) >= size or m[0] != chunk[-1][0] + 1):
+            yield chunk
+            chunk = []
+        chunk.append(m)
+    if chunk:
+        yield chunk
+
+
+def _tasks(folder: str,
+           months: int,
+           manifest: Optional[Manifest] = None,
+           lookback: int = 1,
+           spending_chunk: int = 1,
+           raw: bool = False,
+           balance_batch: int = 0,
+           workers: int = 1,
+           balance_months: int = 0) -> list:
+    """download()のリクエストを ([ファイル名], 取得関数, 引数) のリストにする。
+
+    `manifest`を渡すと、`lookback`ヶ月より古い月で記録のあるものは除く。
+    `balance_months`が正なら、口座残高は今月から遡ってその月数分だけにする。
+    """
+    balance_start = None
+    if balance_months > 0:
+        year, month, _, _ = list(month_ranges(balance_months))[-1]
+        balance_start = '%04d-%02d' % (year, month)
+    tasks = []
     for item in [
             API.ACCOUNT,
             API.ACCOUNT_BALANCES,
@@ -537,31 +1240,185 @@ def download(folder: str, token: str, months: int):
             API.SNAPSHOT,
             API.NET_WORTH,
     ]:
-        data = mt.get(item).json()
-        with open(f'{folder}/{item.name.lower()}.json', 'w') as f:
-            json.dump(data, f)
+        filename = f'{folder}/{item.name.lower()}.json'
+        tasks.append(([filename], _fetch,
+                      (item, filename, {}, raw, balance_batch, workers,
+                       balance_start)))
 
     for item in [
             API.SPENDING,
             API.TRANSACTIONS,
     ]:
+        pending = []
+        for i, (year, month, start_date, end_date) in enumerate(
+                month_ranges(months)):
+            filename = '%s/%s-%04d-%02d.json' % (
+                folder, item.name.lower(), year, month)
+            if manifest is not None and i > lookback \
+                    and manifest.has(filename):
+                continue
+            pending.append((i, '%04d-%02d' % (year, month), filename,
+                            start_date, end_date))
+
+        if item == API.SPENDING and spending_chunk > 1:
+            for chunk in _chunks(pending, spending_chunk):
+                chunk = [m[1:] for m in reversed(chunk)]
+                tasks.append(([m[1] for m in chunk], _fetch_spending_range,
+                              (chunk,)))
+            continue
+        for _, _, filename, start_date, end_date in pending:
+            tasks.append(([filename], _fetch,
+                          (item, filename,
+                           {"start_date": start_date, "end_date": end_date},
+                           raw)))
+    return tasks
+
+
+def _pool_size(workers: int, balance_batch: int) -> int:
+    """`workers`個のスレッドで取得するときの接続プールの大きさ。
+
+    口座残高を分けて取得するときは、1つのスレッドの中でさらに`workers`個の
+    スレッドがリクエストを送るので、その分も足す。
+    """
+    return 2 * workers - 1 if balance_batch else workers
+
+
+def _convert_skipped(folder: str, manifest: Manifest, tasks: list,
+                     compression: Optional[str]):
+    """取り直さないファイルも`compression`の形式で保存し直す"""
+    fetched = {os.path.basename(f) for filenames, _, _ in tasks
+               for f in filenames}
+    for name in manifest.files:
+        if name not in fetched:
+            rawstore.convert(os.path.join(folder, name), compression)
+
+
+def _fail(failures: dict, filenames, error: Exception,
+          label: str = "failed"):
+    """取得できなかったファイルを {ファイル名: 例外} に記録する"""
+    for filename in filenames:
+        failures[filename] = error
+        print(f"{label}: {filename}: {error}", file=sys.stderr)
+
+
+def download(folder: str,
+             token: str,
+             months: int,
+             *,
+             workers: int = 1,
+             incremental: bool = False,
+             lookback: int = 1,
+             spending_chunk: int = 1,
+             raw: bool = False,
+             compression: Optional[str] = None,
+             metrics: Optional[RunMetrics] = None,
+             token_refresher: Optional[Callable[[str], str]] = None,
+             rate_limiter: Optional[RateLimiter] = None,
+             balance_batch: int = 0,
+             balance_months: int = 0,
+             concurrency=None,
+             resume: bool = False):
+    """APIに登録されているキーをすべて実行して、
+    `API.name`.json というファイル名で保存する。
 
-        current_date = datetime.now()
-        for i in range(months):
-            month_date = current_date - relativedelta(months=i)
-            year = month_date.year
-            month = month_date.month
-            last_day = calendar.monthrange(year, month)[1]
+    `workers`個のスレッドでリクエストを並行に投げる。
+    失敗したリクエストは {ファイル名: 例外} として返し、
+    成功した分のファイルはそのまま残す。
 
-            start_date = '%4d-%02d-01' % (year, month)
-            end_date = '%4d-%02d-%2d' % (year, month, last_day)
+    `incremental`が真のときは、今月と`lookback`ヶ月前までの月だけを取り直し、
+    それより古い月はmanifest.jsonに記録があれば取得せず、
+    保存形式が`compression`と違えば手元で書き直す。
 
-            data = mt.get(item, start_date=start_date,
-                          end_date=end_date).json()
-            filename = '%s/%s-%04d-%02d.json' % (
-                folder, item.name.lower(), year, month)
-            with open(filename, 'w') as f:
-                json.dump(data, f)
+    `spending_chunk`が2以上のときは、SPENDINGを最大その月数ずつまとめて取得し、
+    spending-YYYY-MM.json に分割して保存する。
+
+    `raw`が真なら、できるものはレスポンスの本文をパースせずにそのまま保存する。
+    `compression`("gzip", "zstd")を指定すると xxx.json.gz などに圧縮して保存する。
+    zstdには zstandard パッケージが必要で、なければ取得を始める前にImportErrorになる。
+    読み込みには`rawstore`を使う。
+
+    `metrics`を渡すと、リクエストごとの計測とファイル数・失敗数を記録する。
+
+    `token_refresher`を渡すと、途中で401になったときにトークンを取り直して続ける。
+    取り直せなかったとき(AuthError)は、まだ始まっていないリクエストを取り消し、
+    それらも失敗として返す。
+
+    `rate_limiter`を渡すと、すべてのリクエストをそのレート以下に抑える。
+
+    `balance_batch`が正なら、ACCOUNT_BALANCESをその口座数ずつ並行に取得して
+    1つのaccount_balances.jsonにまとめる。
+    `balance_months`が正なら、account_balances.jsonには今月から遡ってその月数分の
+    残高だけを保存する(APIからは全期間を受け取る)。
+
+    `concurrency`にセマフォを渡すと、同時に送るリクエスト数をそれで抑える。
+
+    保存は一時ファイルからのrenameで行い、保存し終えたファイルはjournal.jsonlに記録する。
+    `resume`が真なら、前回途中で終わった実行の記録にあるファイルは取得しない。
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    rawstore.check_compression(compression)
+    manifest = Manifest(folder)
+    journal = Journal(folder, resume, {
+        "months": months,
+        "start": datetime.now().strftime("%Y-%m"),
+        "spending_chunk": spending_chunk,
+        "compression": compression,
+    })
+    tasks = [
+        t for t in _tasks(folder, months, manifest if incremental else None,
+                          lookback, spending_chunk, raw, balance_batch,
+                          workers, balance_months)
+        if not journal.is_done(t[0])
+    ]
+    if incremental:
+        _convert_skipped(folder, manifest, tasks, compression)
+
+    failures = {}
+    with Moneytree(token, pool_size=_pool_size(workers, balance_batch),
+                   token_refresher=token_refresher,
+                   rate_limiter=rate_limiter,
+                   concurrency=concurrency) as mt, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        if metrics is not None:
+            mt.hooks.append(metrics)
+        futures = {
+            executor.submit(_store, manifest, compression, fetch, mt, *args):
+            filenames
+            for filenames, fetch, args in tasks
+        }
+        stopped = None
+        try:
+            for future in as_completed(futures):
+                if future.cancelled():
+                    _fail(failures, futures[future], stopped, "skipped")
+                    continue
+                try:
+                    written = future.result()
+                except AuthError as e:
+                    _fail(failures, futures[future], e)
+                    if stopped is None:
+                        stopped = e
+                        for pending in futures:
+                            pending.cancel()
+                    continue
+                except Exception as e:  # 1リクエストの失敗で全体を止めない
+                    _fail(failures, futures[future], e)
+                    continue
+                journal.record(written)
+                if metrics is not None:
+                    changed = sum(written.values())
+                    metrics.count("files_written", changed)
+                    metrics.count("files_unchanged", len(written) - changed)
+        finally:
+            # 途中で止まっても、保存できた分は台帳に残す
+            manifest.save()
+    if not failures:
+        journal.finish()
+    if metrics is not None:
+        metrics.count("failures", len(failures))
+        metrics.finish()
+    return failures
 
 
 if __name__ == "__main__":
@@ -573,13 +1430,72 @@ if __name__ == "__main__":
     # print(json.dumps(json_data, indent=4, ensure_ascii=False))
     # print(len(json_data["transactions"]))
 
+    parser = argparse.ArgumentParser(description="moneytree scraping")
+    parser.add_argument("folder", help="JSONの保存先")
+    parser.add_argument("months", nargs="?", type=int, default=18,
+                        help="遡って取得する月数")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="並行リクエスト数")
+    parser.add_argument("--incremental", action="store_true",
+                        help="古い月は取得済みなら取り直さない")
+    parser.add_argument("--lookback", type=int, default=1,
+                        help="--incremental時に今月に加えて取り直す月数")
+    parser.add_argument("--spending-chunk", type=int, default=1,
+                        help="SPENDINGを1リクエストでまとめて取得する最大月数")
+    parser.add_argument("--raw", action="store_true",
+                        help="レスポンスをパースせずにそのまま保存する")
+    parser.add_argument("--compress", choices=rawstore.COMPRESSIONS,
+                        help="圧縮して保存する")
+    parser.add_argument("--rate", type=float,
+                        help="1秒あたりの最大リクエスト数")
+    parser.add_argument("--burst", type=int, default=1,
+                        help="--rateで瞬間的に許すリクエスト数")
+    parser.add_argument("--balance-batch", type=int, default=0,
+                        help="口座残高をこの口座数ずつ分けて取得する")
+    parser.add_argument("--balance-months", type=int, default=0,
+                        help="口座残高は今月から遡ってこの月数分だけを保存する")
+    parser.add_argument("--resume", action="store_true",
+                        help="前回途中で終わった実行の続きから取得する")
+    parser.add_argument("--metrics-dir",
+                        help="metrics.json と moneytree.prom を書き出すフォルダ")
+    parser.add_argument("--csv", metavar="OUTPUT_DIR",
+                        help="取得後にCSVへ変換して保存する")
+    parser.add_argument("--parquet", metavar="OUTPUT_DIR",
+                        help="取得後に変わった月の分をParquetへ書き出す")
+    args = parser.parse_args()
+
     # login
-    with open("./bearer_token", mode="r", encoding="utf-8") as f:
-        token = f.readline().replace("\n", "", -1).replace("Bearer ", "")
-
-    args = sys.argv[1:]
-    folder = args[0]
-    if len(args) == 1:
-        download(folder, token, 18)
-    else:
-        download(folder, token, int(args[1]))
+    # bearer_tokenが期限切れのときだけlogin.pyを実行する
+    from token_manager import TokenManager
+    tokens = TokenManager()
+    token = tokens.get()
+
+    metrics = RunMetrics() if args.metrics_dir else None
+    failures = download(args.folder,
+                        token,
+                        args.months,
+                        workers=args.workers,
+                        incremental=args.incremental,
+                        lookback=args.lookback,
+                        spending_chunk=args.spending_chunk,
+                        raw=args.raw,
+                        compression=args.compress,
+                        metrics=metrics,
+                        token_refresher=tokens.refresh,
+                        rate_limiter=RateLimiter(args.rate, args.burst),
+                        balance_batch=args.balance_batch,
+                        balance_months=args.balance_months,
+                        resume=args.resume)
+    if metrics is not None:
+        os.makedirs(args.metrics_dir, exist_ok=True)
+        metrics.write_json(os.path.join(args.metrics_dir, "metrics.json"))
+        metrics.write_prometheus(
+            os.path.join(args.metrics_dir, "moneytree.prom"))
+    if failures:
+        sys.exit(f"{len(failures)} request(s) failed")
+    if args.csv:
+        from convert import convert
+        convert(args.folder, args.csv)
+    if args.parquet:
+        from parquet_export import export
+        export(args.folder, args.parquet)
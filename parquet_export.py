@@ -0,0 +1,230 @@
+#!/usr/bin/python
+"""download()で保存したJSONをParquetへ書き出します。
+
+transactions, account_balances, spending, net_worth を
+year=YYYY/month=MM でパーティション分割したデータセットにします。
+transactions と spending のパーティションは、行の日付ではなくファイル名の月です
+(load_db.py の month カラムと同じ)。
+前回から内容の変わったファイルに対応するパーティションだけを書き直すので、
+download()のたびに実行しても増えた・変わった月の分しか書きません。
+
+# Usage
+
+```
+python3 parquet_export.py raw_dir parquet_dir
+```
+
+```python
+import pyarrow.dataset as ds
+table = ds.dataset("data/parquet/transactions", partitioning="hive").to_table()
+```
+"""
+import json
+import os
+import re
+import shutil
+import sys
+from datetime import date, datetime
+from typing import Optional
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import rawstore
+from moneytree_scraping import month_key
+
+STATE_FILE = "export_state.json"
+
+# transactions-YYYY-MM.json などの月
+FILE_MONTH = re.compile(r"-(\d{4}-\d{2})\.json$")
+
+PARTITIONING = ds.partitioning(pa.schema([("year", pa.int16()),
+                                          ("month", pa.int8())]),
+                               flavor="hive")
+
+TRANSACTIONS_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("amount", pa.float64()),
+    ("date", pa.date32()),
+    ("description_guest", pa.string()),
+    ("description_pretty", pa.string()),
+    ("description_raw", pa.string()),
+    ("raw_transaction_id", pa.int64()),
+    ("created_at", pa.timestamp("us", tz="UTC")),
+    ("updated_at", pa.timestamp("us", tz="UTC")),
+    ("expense_type", pa.int32()),
+    ("predicted_expense_type", pa.int32()),
+    ("category_id", pa.int64()),
+    ("account_id", pa.int64()),
+    ("claim_id", pa.int64()),
+    ("year", pa.int16()),
+    ("month", pa.int8()),
+])
+ACCOUNT_BALANCES_SCHEMA = pa.schema([
+    ("account_id", pa.int64()),
+    ("account_type", pa.string()),
+    ("currency", pa.string()),
+    ("date", pa.date32()),
+    ("balance", pa.float64()),
+    ("balance_in_base", pa.float64()),
+    ("year", pa.int16()),
+    ("month", pa.int8()),
+])
+SPENDING_SCHEMA = pa.schema([
+    ("date", pa.date32()),
+    ("category_id", pa.int64()),
+    ("value", pa.float64()),
+    ("year", pa.int16()),
+    ("month", pa.int8()),
+])
+NET_WORTH_SCHEMA = pa.schema([
+    ("type", pa.string()),
+    ("date", pa.date32()),
+    ("net_worth", pa.float64()),
+    ("net_worth_in_base", pa.float64()),
+    ("year", pa.int16()),
+    ("month", pa.int8()),
+])
+
+
+def _date(value: str) -> date:
+    """YYYY-MM または YYYY-MM-DD"""
+    return date.fromisoformat(value[:10] if len(value) > 7 else value + "-01")
+
+
+def _timestamp(value):
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _table(schema: pa.Schema, rows: list) -> pa.Table:
+    """行(dict)のリストから、年月の列を足してテーブルを作る"""
+    for row in rows:
+        row["year"] = row["date"].year
+        row["month"] = row["date"].month
+    return pa.Table.from_pylist(rows, schema=schema)
+
+
+def transactions_table(data) -> pa.Table:
+    rows = []
+    for t in data["transactions"]:
+        row = {
+            name: t.get(name)
+            for name in TRANSACTIONS_SCHEMA.names[:-2]
+        }
+        row["date"] = _date(t["date"])
+        row["created_at"] = _timestamp(t.get("created_at"))
+        row["updated_at"] = _timestamp(t.get("updated_at"))
+        rows.append(row)
+    return _table(TRANSACTIONS_SCHEMA, rows)
+
+
+def account_balances_table(data) -> pa.Table:
+    return _table(ACCOUNT_BALANCES_SCHEMA, [{
+        "account_id": int(account["account_id"]),
+        "account_type": account.get("account_type"),
+        "currency": account.get("currency"),
+        "date": _date(b["month"]),
+        "balance": b["balance"],
+        "balance_in_base": b["balance_in_base"],
+    } for account in data["account_balances"]
+        for b in account["monthly_balances"]])
+
+
+def spending_table(data) -> pa.Table:
+    return _table(SPENDING_SCHEMA, [{
+        # start_dateは MM/DD/YYYY のこともある
+        "date": _date(month_key(total["start_date"])),
+        "category_id": int(category_id),
+        "value": value,
+    } for total in data["category_totals"]
+        for category_id, value in total["categories"].items()])
+
+
+def net_worth_table(data) -> pa.Table:
+    rows = [dict(r, type="total") for r in data["net_worth"]]
+    for type_, balances in data["account_type_balances"].items():
+        if isinstance(balances, dict):
+            balances = [balances]
+        rows.extend(dict(b, type=type_) for b in balances)
+    return _table(NET_WORTH_SCHEMA, [{
+        "type": r["type"],
+        "date": _date(r["month"]),
+        "net_worth": r["net_worth"],
+        "net_worth_in_base": r["net_worth_in_base"],
+    } for r in rows])
+
+
+def partition_dir(base_dir: str, month: str) -> str:
+    """YYYY-MM のパーティションのフォルダ"""
+    return os.path.join(base_dir, f"year={int(month[:4])}",
+                        f"month={int(month[5:7])}")
+
+
+def write_partitions(table: pa.Table, base_dir: str,
+                     month: Optional[str] = None):
+    """tableに含まれる年月のパーティションだけを置き換える。
+
+    `month`(YYYY-MM)を渡すと、行の日付にかかわらずすべての行をその月の
+    パーティションに入れ(月末の取引が翌月のファイルに入っていることがある)、
+    tableが空でもその月のパーティションは消す。
+    """
+    if month is not None:
+        shutil.rmtree(partition_dir(base_dir, month), ignore_errors=True)
+        table = table.set_column(
+            table.schema.get_field_index("year"), "year",
+            pa.array([int(month[:4])] * table.num_rows, pa.int16()))
+        table = table.set_column(
+            table.schema.get_field_index("month"), "month",
+            pa.array([int(month[5:7])] * table.num_rows, pa.int8()))
+    if table.num_rows == 0:
+        return
+    ds.write_dataset(table,
+                     base_dir,
+                     format="parquet",
+                     partitioning=PARTITIONING,
+                     existing_data_behavior="delete_matching",
+                     basename_template="part-{i}.parquet")
+
+
+EXPORTS = [
+    # (rawファイルのパターン, データセット名, テーブルを作る関数)
+    ("transactions-*.json", "transactions", transactions_table),
+    ("spending-*.json", "spending", spending_table),
+    ("account_balances.json", "account_balances", account_balances_table),
+    ("net_worth.json", "net_worth", net_worth_table),
+]
+
+
+def export(data_dir: str, output_dir: str, full: bool = False) -> list:
+    """前回から変わったrawファイルの分だけParquetへ書き出す。
+    書き出したrawファイル名のリストを返す。"""
+    os.makedirs(output_dir, exist_ok=True)
+    state_path = os.path.join(output_dir, STATE_FILE)
+    state = {}
+    if not full and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+
+    exported = []
+    for pattern, name, build in EXPORTS:
+        for path, key, digest in rawstore.changed(data_dir, pattern, state):
+            # 月ごとのファイルは、ファイル名の月のパーティションを置き換える
+            month = FILE_MONTH.search(key)
+            write_partitions(build(rawstore.load(path)),
+                             os.path.join(output_dir, name),
+                             month and month.group(1))
+            state[key] = digest
+            exported.append(key)
+
+    with rawstore.atomic_write(state_path) as f:
+        f.write(json.dumps(state, indent=1, sort_keys=True).encode())
+    return exported
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: parquet_export.py raw_dir parquet_dir")
+    for name in export(sys.argv[1], sys.argv[2]):
+        print(f"exported {name}")
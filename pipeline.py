@@ -0,0 +1,277 @@
+#!/usr/bin/python
+"""取得 → 変換 → DB書き込み を1回で行うパイプライン
+
+download() でJSONを保存し、load_db.py で読み直す代わりに、
+取得したJSONをそのまま行に変換してSQLiteへupsertします。
+3つの段階は別スレッドで動き、上限つきのキューでつながっているので、
+ある月をDBへ書いている間に次の月を取得できます。
+キューが詰まると前の段階が待つので、メモリに溜まるのはキューの長さ分だけです。
+
+`raw_dir`を指定すると、変換の段階で生JSONも download() と同じ形式で保存します。
+convert.py, changefeed.py などの生JSONを読む処理を続けて使うときは指定してください。
+取り込んだファイルは load_db.py と同じく loaded_files に記録し、
+`incremental`で取り直さなかった月も、DBに入っていなければ`raw_dir`から取り込みます。
+
+# Usage
+
+```
+python3 pipeline.py data 6 --workers 4 --archive --incremental
+```
+
+data/out/moneytree.db に書き込み、`--archive`なら data/raw に生JSONも保存します。
+"""
+import argparse
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import load_db
+import rawstore
+from metrics import RunMetrics
+from moneytree_scraping import (AuthError, Manifest, Moneytree,
+                                _convert_skipped, _fail, _pool_size,
+                                _tasks)
+from ratelimit import RateLimiter
+
+# 段階の終わりを次の段階へ知らせる印
+DONE = object()
+
+
+class Stopped(Exception):
+    """他の段階が失敗したので止まる"""
+
+
+def _put(q: queue.Queue, item, stop: threading.Event):
+    while True:
+        if stop.is_set():
+            raise Stopped()
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while True:
+        if stop.is_set():
+            raise Stopped()
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+
+def _fetch_stage(mt: Moneytree, tasks: list, workers: int,
+                 out: queue.Queue, failures: dict, stop: threading.Event):
+    """`workers`個のスレッドで取得し、{ファイル名: JSON} を1つずつ`out`へ送る。
+
+    トークンを取り直せなかったら(AuthError)、残りのリクエストは送らずに失敗とする。
+    """
+    halted = []
+
+    def work(filenames, fetch, args):
+        if stop.is_set():
+            return
+        if halted:
+            _fail(failures, filenames, halted[0], "skipped")
+            return
+        try:
+            result = fetch(mt, *args)
+        except AuthError as e:
+            halted.append(e)
+            _fail(failures, filenames, e)
+            return
+        except Exception as e:  # 1リクエストの失敗で全体を止めない
+            _fail(failures, filenames, e)
+            return
+        for item in result.items():
+            _put(out, item, stop)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(work, *task) for task in tasks]
+        for future in futures:
+            future.result()
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        executor.shutdown(cancel_futures=True)
+    _put(out, DONE, stop)
+
+
+def _normalize_stage(inp: queue.Queue, out: queue.Queue,
+                     manifest: Optional[Manifest], compression: Optional[str],
+                     stop: threading.Event):
+    """JSONをload_db.replaceの引数に変換する。manifestがあれば生JSONも保存する
+
+    `out`へは (ファイル名, 保存した内容のsha256, replaceの引数のリスト) を送る。
+    sha256はmanifestがないときはNone。
+    """
+    try:
+        while True:
+            item = _get(inp, stop)
+            if item is DONE:
+                break
+            filename, data = item
+            name = os.path.basename(filename)
+            digest = None
+            if manifest is not None:
+                manifest.write(filename, data, compression)
+                digest = manifest.files[name]["sha256"]
+            _put(out, (name, digest, load_db.statements(name, data)), stop)
+    except BaseException:
+        stop.set()
+        raise
+    _put(out, DONE, stop)
+
+
+def run(token: str,
+        months: int,
+        db_path: str,
+        raw_dir: Optional[str] = None,
+        compression: Optional[str] = None,
+        workers: int = 4,
+        queue_size: int = 4,
+        incremental: bool = False,
+        lookback: int = 1,
+        spending_chunk: int = 1,
+        balance_batch: int = 0,
+        balance_months: int = 0,
+        metrics: Optional[RunMetrics] = None,
+        token_refresher: Optional[Callable[[str], str]] = None,
+        rate_limiter: Optional[RateLimiter] = None) -> dict:
+    """取得したものを順にDBへupsertする。失敗したリクエストを {ファイル名: 例外} で返す。
+
+    1ファイル分ずつコミットするので、途中で失敗してもそれまでの分はDBに残る。
+    `incremental`は`raw_dir`のmanifest.jsonを使うので、`raw_dir`が必要。
+    """
+    if incremental and raw_dir is None:
+        raise ValueError("incremental requires raw_dir")
+    rawstore.check_compression(compression)
+    manifest = None
+    if raw_dir is not None:
+        os.makedirs(raw_dir, exist_ok=True)
+        manifest = Manifest(raw_dir)
+    tasks = _tasks(raw_dir or ".", months,
+                   manifest if incremental else None, lookback,
+                   spending_chunk, balance_batch=balance_batch,
+                   workers=workers, balance_months=balance_months)
+    if incremental:
+        _convert_skipped(raw_dir, manifest, tasks, compression)
+
+    fetched = queue.Queue(maxsize=queue_size)
+    normalized = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    failures = {}
+    conn = load_db.connect(db_path)
+    try:
+        with Moneytree(token, pool_size=_pool_size(workers, balance_batch),
+                       token_refresher=token_refresher,
+                       rate_limiter=rate_limiter) as mt, \
+                ThreadPoolExecutor(max_workers=2) as stages:
+            if metrics is not None:
+                mt.hooks.append(metrics)
+            fetch = stages.submit(_fetch_stage, mt, tasks, workers, fetched,
+                                  failures, stop)
+            normalize = stages.submit(_normalize_stage, fetched, normalized,
+                                      manifest, compression, stop)
+            try:
+                # SQLiteの接続はこのスレッドだけで使う
+                while True:
+                    item = _get(normalized, stop)
+                    if item is DONE:
+                        break
+                    name, digest, statements = item
+                    with conn:
+                        changed = sum(
+                            load_db.replace(conn, *s) for s in statements)
+                        if digest is not None:
+                            load_db.mark_loaded(conn, name, digest)
+                    if metrics is not None:
+                        metrics.count("files_stored")
+                        metrics.count("rows_changed", changed)
+            except Stopped:
+                pass
+            except BaseException:
+                stop.set()
+                raise
+            finally:
+                if manifest is not None:
+                    manifest.save()
+            # 先に失敗した段階の例外を投げ直す(Stoppedはそれに巻き込まれたもの)
+            for error in (fetch.exception(), normalize.exception()):
+                if error is not None and not isinstance(error, Stopped):
+                    raise error
+        if raw_dir is not None:
+            # 取り直さなかったファイルのうち、DBに入っていないもの
+            # (DBを作り直した直後など)を取り込む
+            changed = load_db.load_changed(conn, raw_dir)
+            if metrics is not None:
+                metrics.count("rows_changed", changed)
+    finally:
+        conn.close()
+    if metrics is not None:
+        metrics.count("failures", len(failures))
+        metrics.finish()
+    return failures
+
+
+if __name__ == "__main__":
+    from token_manager import TokenManager
+
+    parser = argparse.ArgumentParser(description="moneytree pipeline")
+    parser.add_argument("folder",
+                        help="out/moneytree.db (と raw/) を置くフォルダ")
+    parser.add_argument("months", type=int, nargs="?", default=18)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=4,
+                        help="段階の間のキューの長さ")
+    parser.add_argument("--archive", action="store_true",
+                        help="生JSONもfolder/rawに保存する")
+    parser.add_argument("--compress", choices=rawstore.COMPRESSIONS)
+    parser.add_argument("--incremental", action="store_true",
+                        help="--archiveのmanifestを見て、古い月は取り直さない")
+    parser.add_argument("--lookback", type=int, default=1)
+    parser.add_argument("--spending-chunk", type=int, default=1)
+    parser.add_argument("--balance-batch", type=int, default=0)
+    parser.add_argument("--balance-months", type=int, default=0,
+                        help="口座残高は今月から遡ってこの月数分だけを保存する")
+    parser.add_argument("--rate", type=float,
+                        help="1秒あたりのリクエスト数の上限")
+    parser.add_argument("--burst", type=int, default=1)
+    parser.add_argument("--metrics-dir",
+                        help="metrics.json と moneytree.prom を書き出すフォルダ")
+    args = parser.parse_args()
+
+    raw_dir = os.path.join(args.folder, "raw") if args.archive else None
+    out_dir = os.path.join(args.folder, "out")
+    os.makedirs(out_dir, exist_ok=True)
+    metrics = RunMetrics() if args.metrics_dir else None
+    tokens = TokenManager()
+    failures = run(tokens.get(),
+                   args.months,
+                   os.path.join(out_dir, "moneytree.db"),
+                   raw_dir=raw_dir,
+                   compression=args.compress,
+                   workers=args.workers,
+                   queue_size=args.queue_size,
+                   incremental=args.incremental,
+                   lookback=args.lookback,
+                   spending_chunk=args.spending_chunk,
+                   balance_batch=args.balance_batch,
+                   balance_months=args.balance_months,
+                   metrics=metrics,
+                   token_refresher=tokens.refresh,
+                   rate_limiter=RateLimiter(args.rate, args.burst))
+    if metrics is not None:
+        os.makedirs(args.metrics_dir, exist_ok=True)
+        metrics.write_json(os.path.join(args.metrics_dir, "metrics.json"))
+        metrics.write_prometheus(
+            os.path.join(args.metrics_dir, "moneytree.prom"))
+    if failures:
+        sys.exit(f"{len(failures)} request(s) failed")
@@ -0,0 +1,114 @@
+"""Moneytree APIへのリクエストのレート制限
+
+トークンバケットで1秒あたりのリクエスト数を`rate`、瞬間的な上限を`burst`に抑えます。
+429/503を受けたら`Retry-After`の間(なければ指数バックオフ)は全体で送信を止めます。
+1つのインスタンスを複数のMoneytreeで共有できます。
+
+# Usage
+
+```python
+limiter = RateLimiter(rate=5, burst=10)
+mt = Moneytree(token, rate_limiter=limiter)
+limiter.state()
+```
+"""
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+THROTTLE_STATUSES = (429, 503)
+
+
+def retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-Afterヘッダー(秒数またはHTTP日付)を待つ秒数にする"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    """スレッドセーフなトークンバケット
+
+    `rate`がNoneなら送信数は制限せず、429/503による一時停止だけを行います。
+    """
+
+    def __init__(self,
+                 rate: Optional[float] = None,
+                 burst: int = 1,
+                 backoff: float = 1.0,
+                 max_backoff: float = 60.0):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.tokens = float(self.burst)
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self.waiting = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if self.rate is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """送信してよくなるまで待つ"""
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now < self.blocked_until:
+                        wait = self.blocked_until - now
+                    elif self.rate is None:
+                        return
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    else:
+                        wait = (1 - self.tokens) / self.rate
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def throttle(self, attempt: int, after: Optional[float] = None) -> float:
+        """429/503を受けたときに呼ぶ。全体の送信を止める秒数を返す"""
+        if after is None:
+            after = min(self.max_backoff, self.backoff * 2**attempt)
+        with self._lock:
+            self.throttled += 1
+            self.blocked_until = max(self.blocked_until,
+                                     time.monotonic() + after)
+        return after
+
+    def state(self) -> dict:
+        """現在のスロットリングの状態"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "tokens": self.tokens,
+                "throttled": self.throttled,
+                "waiting": self.waiting,
+                "blocked_for": max(0.0, self.blocked_until - now),
+            }
@@ -0,0 +1,188 @@
+"""download()で保存した生JSONの読み書き
+
+ファイルは`xxx.json`のまま、または圧縮して`xxx.json.gz`/`xxx.json.zst`で保存されます。
+読む側はどの形式かを気にせず、`xxx.json`のパスで扱えます。
+
+# Usage
+
+```python
+import rawstore
+for path in rawstore.glob("data/raw", "transactions-*.json"):
+    data = rawstore.load(path)
+```
+"""
+import glob as _glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+# download()が保存したファイルのsha256などを記録する台帳
+MANIFEST = "manifest.json"
+
+
+# この環境で使える圧縮形式(--compressの選択肢)
+COMPRESSIONS = ["gzip"] + (["zstd"] if zstandard is not None else [])
+
+
+def _zstd():
+    if zstandard is None:
+        raise ImportError("zstd圧縮には zstandard パッケージが必要です")
+    return zstandard
+
+
+def check_compression(compression: Optional[str]):
+    """`compression`で保存できるか。取得を始める前に呼んで、できなければ例外にする"""
+    if compression not in SUFFIXES:
+        raise ValueError(f"unknown compression: {compression}")
+    if compression == "zstd":
+        _zstd()
+
+
+def resolve(path: str) -> Optional[str]:
+    """実際に存在するファイルのパス(圧縮の拡張子付き)。なければNone
+
+    圧縮形式を変えて書いた直後に落ちると古い形式のファイルも残るので、
+    複数あるときは一番新しいものを返す。
+    """
+    found = [path + s for s in SUFFIXES.values() if os.path.exists(path + s)]
+    if len(found) > 1:
+        return max(found, key=lambda p: os.stat(p).st_mtime_ns)
+    return found[0] if found else None
+
+
+def exists(path: str) -> bool:
+    return resolve(path) is not None
+
+
+def open_read(path: str):
+    """展開済みの内容を読むバイナリファイルを開く"""
+    real = resolve(path)
+    if real is None:
+        raise FileNotFoundError(path)
+    if real.endswith(".gz"):
+        return gzip.open(real, "rb")
+    if real.endswith(".zst"):
+        return _zstd().open(real, "rb")
+    return open(real, "rb")
+
+
+def read_bytes(path: str) -> bytes:
+    with open_read(path) as f:
+        return f.read()
+
+
+def load(path: str):
+    """JSONを読み込む"""
+    with open_read(path) as f:
+        return json.load(f)
+
+
+def glob(folder: str, pattern: str):
+    """patternに合うファイルの(圧縮の拡張子を除いた)パスを名前順に返す"""
+    paths = set()
+    for suffix in SUFFIXES.values():
+        for path in _glob.glob(os.path.join(folder, pattern + suffix)):
+            paths.add(path[:len(path) - len(suffix)] if suffix else path)
+    return sorted(paths)
+
+
+def _manifest_digests(folder: str) -> dict:
+    """manifest.jsonに記録された {ファイル名: sha256}。
+
+    manifest.jsonを保存した後に書き換えられたファイルは含めない。
+    タイムスタンプの粗いファイルシステムでも取りこぼさないよう、
+    manifest.jsonと同じ時刻のファイルも含めない(読んで確かめる)。
+    """
+    path = os.path.join(folder, MANIFEST)
+    try:
+        with open(path) as f:
+            files = json.load(f)["files"]
+        saved = os.stat(path).st_mtime_ns
+    except (FileNotFoundError, ValueError, KeyError):
+        return {}
+    digests = {}
+    for name, entry in files.items():
+        real = resolve(os.path.join(folder, name))
+        if real is not None and os.stat(real).st_mtime_ns < saved:
+            digests[name] = entry["sha256"]
+    return digests
+
+
+def changed(folder: str, pattern: str, seen: dict):
+    """`pattern`に合うファイルのうち、内容のsha256が`seen`({ファイル名: sha256})と
+    違うものを (パス, ファイル名, sha256) で順に返す。
+
+    manifest.jsonに記録のあるファイルはそのsha256を使い、読み込まない。
+    """
+    digests = _manifest_digests(folder)
+    for path in glob(folder, pattern):
+        name = os.path.basename(path)
+        digest = digests.get(name)
+        if digest is None:
+            digest = hashlib.sha256(read_bytes(path)).hexdigest()
+        if seen.get(name) != digest:
+            yield path, name, digest
+
+
+def _open_write(real: str, compression: Optional[str]):
+    if compression == "gzip":
+        return gzip.open(real, "wb")
+    if compression == "zstd":
+        return _zstd().open(real, "wb")
+    return open(real, "wb")
+
+
+def open_write(path: str, compression: Optional[str] = None):
+    """`compression`で圧縮して書き込むバイナリファイルを開く"""
+    return _open_write(path + SUFFIXES[compression], compression)
+
+
+@contextmanager
+def atomic_write(path: str, compression: Optional[str] = None):
+    """一時ファイルに書いてからrenameする`open_write`。
+
+    途中で落ちても書きかけのファイルが`path`に残らない。
+    """
+    real = path + SUFFIXES[compression]
+    tmp = f"{real}.{os.getpid()}.tmp"
+    try:
+        with _open_write(tmp, compression) as f:
+            yield f
+        with open(tmp, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, real)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def remove_other_variants(path: str, compression: Optional[str] = None):
+    """圧縮形式を変えたときに残る古い形式のファイルを消す"""
+    for c, suffix in SUFFIXES.items():
+        if c != compression and os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def convert(path: str, compression: Optional[str] = None) -> bool:
+    """保存済みのファイルを`compression`の形式で書き直す。書き直したらTrue"""
+    real = resolve(path)
+    if real is None:
+        return False
+    if real == path + SUFFIXES[compression]:
+        remove_other_variants(path, compression)
+        return False
+    with open_read(path) as src, atomic_write(path, compression) as dst:
+        shutil.copyfileobj(src, dst)
+    remove_other_variants(path, compression)
+    return True
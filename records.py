@@ -0,0 +1,234 @@
+"""APIレスポンスの型付きレコード
+
+SimpleNamespaceはインスタンスごとに`__dict__`を持つので、
+何年分ものトランザクションを読み込むとメモリを食います。
+ここのレコードは`__slots__`付きのdataclassで、必要なフィールドだけを持ちます。
+
+# Usage
+
+```python
+from records import Transaction, TransactionBatch
+resp = mt.get(API.TRANSACTIONS, start_date="2023-06-01", end_date="2023-06-30")
+transactions = resp.records(Transaction)
+batch = TransactionBatch.from_records(resp.json()["transactions"])
+batch.amount.tolist()
+```
+"""
+from array import array
+from dataclasses import dataclass
+from typing import ClassVar, List, Optional
+
+
+class Record:
+    """JSONのdictからレコードを作る共通処理"""
+    __slots__ = ()
+    key: ClassVar[str] = ""
+    # object_hookで一緒に作る入れ子のレコードの型
+    nested: ClassVar[tuple] = ()
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(*(data.get(name) for name in cls.__slots__))
+
+    @classmethod
+    def from_json(cls, data: dict) -> list:
+        """レスポンス全体から`key`の配列をレコードのリストにする"""
+        return [
+            d if isinstance(d, cls) else cls.from_dict(d)
+            for d in data[cls.key]
+        ]
+
+    @classmethod
+    def object_hook(cls):
+        """`json.loads`のobject_hook。
+
+        `cls`のフィールドがすべて揃ったオブジェクトと、フィールドがちょうど
+        入れ子の`nested`と同じオブジェクトをパースしながらその場でレコードにするので、
+        dictの木全体をメモリに持たない。フィールドが欠けていたものは`from_json`でdictから作る。
+        """
+        fields = frozenset(cls.__slots__)
+        nested = {frozenset(t.__slots__): t for t in cls.nested}
+
+        def hook(data: dict):
+            keys = data.keys()
+            if keys >= fields:
+                return cls.from_dict(data)
+            record_type = nested.get(frozenset(keys))
+            if record_type is not None:
+                return record_type.from_dict(data)
+            return data
+
+        return hook
+
+
+@dataclass(slots=True)
+class Transaction(Record):
+    key: ClassVar[str] = "transactions"
+    id: int
+    amount: float
+    date: str
+    description_guest: Optional[str]
+    description_pretty: Optional[str]
+    description_raw: Optional[str]
+    raw_transaction_id: Optional[int]
+    created_at: str
+    updated_at: str
+    expense_type: Optional[int]
+    predicted_expense_type: Optional[int]
+    category_id: Optional[int]
+    account_id: int
+    claim_id: Optional[int]
+
+
+@dataclass(slots=True)
+class Account(Record):
+    key: ClassVar[str] = "accounts"
+    id: int
+    guest_id: int
+    nickname: str
+    currency: str
+    credential_id: int
+    account_type: str
+    institution_account_number: Optional[str]
+    institution_account_name: Optional[str]
+    branch_name: Optional[str]
+    status: str
+    last_success_at: Optional[str]
+    group: str
+    detail_type: str
+    sub_type: str
+    current_balance: Optional[float]
+    current_balance_in_base: Optional[float]
+    current_unclosed_balance: Optional[float]
+    current_closed_balance: Optional[float]
+    current_revolving_balance: Optional[float]
+
+
+@dataclass(slots=True)
+class Ref(Record):
+    """`{"id": ...}`だけの参照"""
+    id: int
+
+
+def _ref(value) -> Optional[Ref]:
+    if value is None or isinstance(value, Ref):
+        return value
+    return Ref.from_dict(value)
+
+
+@dataclass(slots=True)
+class Category(Record):
+    key: ClassVar[str] = "categories"
+    nested: ClassVar[tuple] = (Ref, )
+    id: int
+    parent_id: Optional[int]
+    guest_id: Optional[int]
+    category_type: str
+    updated_at: str
+    created_at: str
+    entity_key: Optional[str]
+    name: str
+    icon_key: Optional[str]
+    parent: Optional[Ref]
+    guest: Optional[Ref]
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        values = [data.get(name) for name in cls.__slots__]
+        values[-2:] = (_ref(data.get("parent")), _ref(data.get("guest")))
+        return cls(*values)
+
+
+@dataclass(slots=True)
+class MonthlyBalance(Record):
+    month: str
+    balance: float
+    balance_in_base: Optional[float]
+
+
+@dataclass(slots=True)
+class AccountBalance(Record):
+    key: ClassVar[str] = "account_balances"
+    nested: ClassVar[tuple] = (MonthlyBalance, )
+    account_id: str
+    account_type: str
+    currency: str
+    years: List[int]
+    monthly_balances: List[MonthlyBalance]
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data.get("account_id"), data.get("account_type"),
+                   data.get("currency"), data.get("years"), [
+                       b if isinstance(b, MonthlyBalance) else
+                       MonthlyBalance.from_dict(b)
+                       for b in data.get("monthly_balances", [])
+                   ])
+
+
+@dataclass(slots=True)
+class CategoryTotal(Record):
+    key: ClassVar[str] = "category_totals"
+    start_date: str
+    end_date: str
+    total: float
+    categories: dict
+
+
+class TransactionBatch:
+    """トランザクションを列ごとの配列で持つコンテナ
+
+    数値の列は`array`に詰めるので、1件あたりのオーバーヘッドがほぼありません。
+    category_id, claim_id などの欠損は -1 で表します。
+    """
+    _ints = ("id", "raw_transaction_id", "expense_type",
+             "predicted_expense_type", "category_id", "account_id",
+             "claim_id")
+    _strings = ("date", "description_guest", "description_pretty",
+                "description_raw", "created_at", "updated_at")
+
+    def __init__(self):
+        for name in self._ints:
+            setattr(self, name, array("q"))
+        self.amount = array("d")
+        for name in self._strings:
+            setattr(self, name, [])
+
+    @classmethod
+    def from_records(cls, transactions) -> "TransactionBatch":
+        """dictまたはTransactionの列から作る"""
+        batch = cls()
+        batch.extend(transactions)
+        return batch
+
+    def append(self, transaction):
+        if isinstance(transaction, Transaction):
+            get = transaction.__getattribute__
+        else:
+            get = transaction.get
+        for name in self._ints:
+            value = get(name)
+            getattr(self, name).append(-1 if value is None else value)
+        self.amount.append(get("amount"))
+        for name in self._strings:
+            getattr(self, name).append(get(name))
+
+    def extend(self, transactions):
+        for t in transactions:
+            self.append(t)
+
+    def __len__(self):
+        return len(self.id)
+
+    def __getitem__(self, i: int) -> Transaction:
+        values = {name: getattr(self, name)[i] for name in self._ints}
+        for name in ("raw_transaction_id", "expense_type",
+                     "predicted_expense_type", "category_id", "claim_id"):
+            if values[name] == -1:
+                values[name] = None
+        values["amount"] = self.amount[i]
+        values.update({name: getattr(self, name)[i] for name in self._strings})
+        return Transaction.from_dict(values)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
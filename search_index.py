@@ -0,0 +1,190 @@
+#!/usr/bin/python
+"""取引の摘要(description_raw/pretty/guest)の全文検索インデックス
+
+日本語は単語に区切れないので、摘要を文字のbigram(2文字ずつ)に分けた
+転置インデックスをSQLiteに保存します。表記ゆれを減らすため、
+摘要と検索語はどちらもNFKC正規化(半角カナ→全角など)と小文字化をしてから扱います。
+
+transactions-YYYY-MM.json のうち前回から内容の変わった月だけを作り直します。
+
+# Usage
+
+```
+python3 search_index.py data/out/search.db --raw data/raw   # インデックスの更新
+python3 search_index.py data/out/search.db セブン 渋谷       # 検索(AND)
+```
+
+```python
+index = SearchIndex("data/out/search.db")
+index.update("data/raw")
+for hit in index.search("ｾﾌﾞﾝ"):
+    print(hit["id"], hit["date"], hit["amount"])
+```
+"""
+import argparse
+import unicodedata
+from typing import List, Optional
+
+import load_db
+import rawstore
+
+SCHEMA_VERSION = 1
+# load_db.py のDBと取り違えないための PRAGMA application_id ("MTSI")
+APPLICATION_ID = 0x4D545349
+
+SCHEMA = """
+CREATE TABLE documents (
+    id INTEGER PRIMARY KEY,
+    month TEXT,
+    date TEXT,
+    amount REAL,
+    account_id INTEGER,
+    category_id INTEGER,
+    description_raw TEXT,
+    description_pretty TEXT,
+    description_guest TEXT,
+    text TEXT
+);
+CREATE INDEX documents_month ON documents (month);
+CREATE TABLE postings (
+    gram TEXT,
+    id INTEGER,
+    PRIMARY KEY (gram, id)
+) WITHOUT ROWID;
+CREATE INDEX postings_id ON postings (id);
+CREATE TABLE indexed_files (
+    name TEXT PRIMARY KEY,
+    sha256 TEXT
+);
+"""
+
+FIELDS = ("description_raw", "description_pretty", "description_guest")
+
+
+def normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def ngrams(text: str, n: int = 2) -> set:
+    """空白で区切った各語の文字n-gram。n文字以下の語はそのまま"""
+    grams = set()
+    for word in text.split():
+        if len(word) <= n:
+            grams.add(word)
+        else:
+            grams.update(word[i:i + n] for i in range(len(word) - n + 1))
+    return grams
+
+
+class SearchIndex:
+    """摘要の転置インデックス"""
+
+    def __init__(self, path: str):
+        self.conn = load_db.connect(path, SCHEMA, SCHEMA_VERSION,
+                                    APPLICATION_ID)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, data_dir: str) -> List[str]:
+        """前回から変わった月だけインデックスし直す。その月のリストを返す"""
+        indexed = dict(
+            self.conn.execute("SELECT name, sha256 FROM indexed_files"))
+        updated = []
+        with self.conn:
+            for path, name, digest in rawstore.changed(
+                    data_dir, "transactions-*.json", indexed):
+                month = name[len("transactions-"):-len(".json")]
+                self.index_month(month, rawstore.load(path)["transactions"])
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO indexed_files VALUES (?, ?)",
+                    (name, digest))
+                updated.append(month)
+        return updated
+
+    def index_month(self, month: str, transactions: list):
+        """1か月分の取引を入れ直す。別の月にあった同じIDの取引は移す"""
+        ids = [(t["id"], ) for t in transactions]
+        self.conn.execute(
+            "DELETE FROM postings WHERE id IN "
+            "(SELECT id FROM documents WHERE month = ?)", (month, ))
+        self.conn.execute("DELETE FROM documents WHERE month = ?", (month, ))
+        self.conn.executemany("DELETE FROM postings WHERE id = ?", ids)
+        self.conn.executemany("DELETE FROM documents WHERE id = ?", ids)
+        documents = []
+        postings = []
+        for t in transactions:
+            text = normalize(" ".join(t.get(f) or "" for f in FIELDS))
+            documents.append(
+                (t["id"], month, t.get("date"), t.get("amount"),
+                 t.get("account_id"), t.get("category_id"),
+                 *(t.get(f) for f in FIELDS), text))
+            postings.extend((g, t["id"]) for g in ngrams(text))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO documents VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", documents)
+        self.conn.executemany("INSERT OR IGNORE INTO postings VALUES (?, ?)",
+                              postings)
+
+    def search(self,
+               query: str,
+               limit: Optional[int] = 100,
+               start: Optional[str] = None,
+               end: Optional[str] = None) -> List[dict]:
+        """空白区切りの語をすべて含む取引を日付の新しい順に返す"""
+        words = normalize(query).split()
+        if not words:
+            return []
+        grams = set()
+        for word in words:
+            if len(word) > 1:
+                grams.update(ngrams(word))
+        sql = ("SELECT id, date, amount, account_id, category_id, "
+               + ", ".join(FIELDS) + " FROM documents WHERE ")
+        params = []
+        if grams:
+            # 全てのn-gramを含む候補をインデックスで絞る
+            sql += (f"id IN (SELECT id FROM postings WHERE gram IN "
+                    f"({', '.join('?' * len(grams))}) GROUP BY id "
+                    f"HAVING COUNT(*) = ?) AND ")
+            params += sorted(grams) + [len(grams)]
+        # n-gramが揃っていても並びが違うことがあるので、語そのもので確かめる
+        sql += " AND ".join("instr(text, ?) > 0" for _ in words)
+        params += words
+        if start:
+            sql += " AND date >= ?"
+            params.append(start)
+        if end:
+            sql += " AND substr(date, 1, ?) <= ?"
+            params += [len(end), end]
+        sql += " ORDER BY date DESC, id"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        cursor = self.conn.execute(sql, params)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="moneytree search index")
+    parser.add_argument("db", help="インデックスのSQLiteファイル")
+    parser.add_argument("query", nargs="*", help="検索語(AND)")
+    parser.add_argument("--raw", help="このフォルダの取引でインデックスを更新する")
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    with SearchIndex(args.db) as index:
+        if args.raw:
+            months = index.update(args.raw)
+            print(f"indexed {len(months)} month(s)")
+        if args.query:
+            for hit in index.search(" ".join(args.query), args.limit):
+                print(hit["date"], hit["id"], hit["amount"],
+                      hit["description_pretty"] or hit["description_raw"],
+                      sep="\t")
@@ -0,0 +1,182 @@
+"""月 x カテゴリの支出行列
+
+API.SPENDINGのレスポンス(1つでも複数でも)を、行が月・列がカテゴリIDの
+NumPy配列にまとめます。`Moneytree.rename_category`と違い、
+月ごとの`start_date`/`end_date`/`total`も保持します。
+
+# Usage
+
+```python
+mt = Moneytree(token)
+matrix = mt.spending_matrix("2023-01-01", "2023-12-31")
+matrix.slice("2023-04", "2023-06").totals_by_category()
+matrix.rollup_parents().to_csv("spending_by_parent.csv")
+
+matrix = SpendingMatrix.from_folder("data/raw")
+```
+"""
+import csv
+import os
+import sqlite3
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import rawstore
+from moneytree_scraping import month_key
+
+
+class SpendingMatrix:
+    """支出行列
+
+    values[i, j] が months[i] の category_ids[j] への支出
+    """
+
+    def __init__(self,
+                 months: List[str],
+                 category_ids,
+                 values,
+                 totals=None,
+                 start_dates: Optional[List[str]] = None,
+                 end_dates: Optional[List[str]] = None,
+                 categories: Optional[List[dict]] = None):
+        self.months = list(months)
+        self.category_ids = np.asarray(category_ids, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.totals = (self.values.sum(axis=1) if totals is None else
+                       np.asarray(totals, dtype=np.float64))
+        self.start_dates = start_dates or [f"{m}-01" for m in self.months]
+        self.end_dates = end_dates or [None] * len(self.months)
+        self.categories = categories or []
+        self._columns = {c: j for j, c in enumerate(self.category_ids.tolist())}
+        self._rows = {m: i for i, m in enumerate(self.months)}
+
+    @classmethod
+    def from_spending(cls, *spendings, categories: Optional[List[dict]] = None):
+        """API.SPENDINGのJSON(複数可)から作る。同じ月は後のものを優先"""
+        entries = {}
+        for spending in spendings:
+            for total in spending["category_totals"]:
+                entries[month_key(total["start_date"])] = total
+        months = sorted(entries)
+        ids = sorted({
+            int(k)
+            for total in entries.values() for k in total["categories"]
+        })
+        columns = {c: j for j, c in enumerate(ids)}
+        values = np.zeros((len(months), len(ids)))
+        for i, month in enumerate(months):
+            for k, v in entries[month]["categories"].items():
+                values[i, columns[int(k)]] = v or 0.0
+        return cls(months, ids, values,
+                   [entries[m].get("total") or 0.0 for m in months],
+                   [entries[m].get("start_date") for m in months],
+                   [entries[m].get("end_date") for m in months],
+                   categories)
+
+    @classmethod
+    def from_folder(cls, folder: str):
+        """download()の保存先(spending-*.json, category.json)から作る"""
+        spendings = [
+            rawstore.load(path)
+            for path in rawstore.glob(folder, "spending-*.json")
+        ]
+        categories = None
+        if rawstore.exists(os.path.join(folder, "category.json")):
+            categories = rawstore.load(os.path.join(
+                folder, "category.json"))["categories"]
+        return cls.from_spending(*spendings, categories=categories)
+
+    @property
+    def category_table(self) -> Dict[int, str]:
+        """{カテゴリID: カテゴリ名}"""
+        return {c["id"]: c["name"] for c in self.categories}
+
+    @property
+    def names(self) -> List[str]:
+        """列ごとのカテゴリ名。不明なIDはIDの文字列"""
+        table = self.category_table
+        return [table.get(c, str(c)) for c in self.category_ids.tolist()]
+
+    def column(self, category_id: int) -> np.ndarray:
+        """1カテゴリの月ごとの支出"""
+        return self.values[:, self._columns[category_id]]
+
+    def month(self, month: str) -> Dict[int, float]:
+        """1ヶ月分の {カテゴリID: 支出}"""
+        row = self.values[self._rows[month]]
+        return dict(zip(self.category_ids.tolist(), row.tolist()))
+
+    def slice(self, start: str, end: str) -> "SpendingMatrix":
+        """start <= 月 <= end (YYYY-MM) の行だけの行列"""
+        rows = [i for i, m in enumerate(self.months) if start <= m <= end]
+        return self._take_rows(rows)
+
+    def select(self, category_ids) -> "SpendingMatrix":
+        """指定したカテゴリの列だけの行列"""
+        columns = [self._columns[c] for c in category_ids]
+        return SpendingMatrix(self.months, self.category_ids[columns],
+                              self.values[:, columns], self.totals,
+                              self.start_dates, self.end_dates,
+                              self.categories)
+
+    def _take_rows(self, rows) -> "SpendingMatrix":
+        return SpendingMatrix([self.months[i] for i in rows],
+                              self.category_ids, self.values[rows],
+                              self.totals[rows],
+                              [self.start_dates[i] for i in rows],
+                              [self.end_dates[i] for i in rows],
+                              self.categories)
+
+    def rollup_parents(self) -> "SpendingMatrix":
+        """親カテゴリごとに合計した行列。親のないカテゴリはそれ自身に集計"""
+        parents = {
+            c["id"]: c.get("parent_id") or c["id"]
+            for c in self.categories
+        }
+        parent_ids = np.array(
+            [parents.get(c, c) for c in self.category_ids.tolist()],
+            dtype=np.int64)
+        ids, index = np.unique(parent_ids, return_inverse=True)
+        values = np.zeros((len(self.months), len(ids)))
+        np.add.at(values.T, index, self.values.T)
+        return SpendingMatrix(self.months, ids, values, self.totals,
+                              self.start_dates, self.end_dates,
+                              self.categories)
+
+    def totals_by_month(self) -> Dict[str, float]:
+        """APIが返した月ごとの合計"""
+        return dict(zip(self.months, self.totals.tolist()))
+
+    def totals_by_category(self) -> Dict[int, float]:
+        """カテゴリごとの期間合計"""
+        return dict(
+            zip(self.category_ids.tolist(),
+                self.values.sum(axis=0).tolist()))
+
+    def rows(self):
+        """(month, category_id, category, value) の縦持ち。0は省く"""
+        names = self.names
+        for i, j in zip(*np.nonzero(self.values)):
+            yield (self.months[i], int(self.category_ids[j]), names[j],
+                   float(self.values[i, j]))
+
+    def to_csv(self, path: str):
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["month", "category_id", "category", "value"])
+            writer.writerows(self.rows())
+
+    def to_sqlite(self, path: str, table: str = "spending_matrix"):
+        """(month, category_id) を主キーにしてテーブルを置き換える"""
+        conn = sqlite3.connect(path)
+        try:
+            with conn:
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+                conn.execute(f"CREATE TABLE {table} ("
+                             "month TEXT, category_id INTEGER, category TEXT, "
+                             "value REAL, PRIMARY KEY (month, category_id))")
+                conn.executemany(f"INSERT INTO {table} VALUES (?, ?, ?, ?)",
+                                 self.rows())
+        finally:
+            conn.close()
@@ -0,0 +1,93 @@
+"""ChangeFeed.update の変更検出をモックサーバのデータで確かめる
+
+```
+python3 -m pytest test_changefeed.py
+```
+"""
+import json
+import os
+import tempfile
+import unittest
+
+import rawstore
+from changefeed import ChangeFeed
+from mock_server import MockServer, SyntheticData
+from moneytree_scraping import Moneytree, download
+
+
+class ChangeFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = Moneytree.origin
+        self.tmp = tempfile.TemporaryDirectory()
+        self.raw = os.path.join(self.tmp.name, "raw")
+        self.path = os.path.join(self.tmp.name, "changes.jsonl")
+        os.makedirs(self.raw)
+        with MockServer(SyntheticData(3, 5, 3, 20)) as server:
+            Moneytree.origin = server.origin
+            self.assertEqual(download(self.raw, "test", 3), {})
+        self.first = ChangeFeed(self.path).update(self.raw)
+
+    def tearDown(self):
+        Moneytree.origin = self.origin
+        self.tmp.cleanup()
+
+    def rewrite(self, month, edit):
+        path = os.path.join(self.raw, f"transactions-{month}.json")
+        data = rawstore.load(path)
+        result = edit(data["transactions"])
+        with rawstore.atomic_write(path) as f:
+            f.write(json.dumps(data).encode())
+        return result
+
+    def months(self):
+        return sorted(os.path.basename(p)[len("transactions-"):-len(".json")]
+                      for p in rawstore.glob(self.raw, "transactions-*.json"))
+
+    def update(self):
+        return [(c["op"], c["id"], c["month"])
+                for c in ChangeFeed(self.path).update(self.raw)]
+
+    def test_first_update_inserts_everything(self):
+        self.assertEqual(len(self.first), 60)
+        self.assertEqual({c["op"] for c in self.first}, {"insert"})
+        self.assertEqual([c["seq"] for c in self.first], list(range(1, 61)))
+        self.assertEqual(list(ChangeFeed(self.path).read(after=58)),
+                         self.first[58:])
+
+    def test_unchanged_files_write_nothing(self):
+        self.assertEqual(self.update(), [])
+
+    def test_updated_transaction(self):
+        month = self.months()[0]
+
+        def touch(transactions):
+            transactions[0]["updated_at"] = "2099-01-01T00:00:00Z"
+            return transactions[0]["id"]
+
+        key = self.rewrite(month, touch)
+        self.assertEqual(self.update(), [("update", key, month)])
+
+    def test_deleted_transaction(self):
+        month = self.months()[0]
+        key = self.rewrite(month, lambda t: t.pop()["id"])
+        self.assertEqual(self.update(), [("delete", key, month)])
+        self.assertEqual(self.update(), [])
+
+    def test_moved_transaction_is_an_update(self):
+        source, target = self.months()[:2]
+        moved = self.rewrite(source, lambda t: t.pop())
+        self.rewrite(target, lambda t: t.append(moved))
+        self.assertEqual(self.update(), [("update", moved["id"], target)])
+
+    def test_move_seen_only_in_target_month(self):
+        # 移動先の月だけ取り直した場合も、削除+追加にはならない
+        source, target = self.months()[:2]
+        moved = rawstore.load(os.path.join(
+            self.raw, f"transactions-{source}.json"))["transactions"][0]
+        self.rewrite(target, lambda t: t.append(moved))
+        self.assertEqual(self.update(), [("update", moved["id"], target)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""download(compression=...) の保存形式の切り替えをモックサーバで確かめる
+
+```
+python3 -m pytest test_compression.py
+```
+"""
+import os
+import tempfile
+import unittest
+
+import rawstore
+from mock_server import MockServer, SyntheticData
+from moneytree_scraping import Moneytree, download
+
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = Moneytree.origin
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+
+    def tearDown(self):
+        Moneytree.origin = self.origin
+        self.tmp.cleanup()
+
+    def download(self, **kwargs):
+        with MockServer(SyntheticData(3, 5, 3, 20)) as server:
+            Moneytree.origin = server.origin
+            failures = download(self.folder, "test", 3, **kwargs)
+        self.assertEqual(failures, {})
+        return server.request_count
+
+    def suffixes(self):
+        names = [n for n in os.listdir(self.folder)
+                 if n != rawstore.MANIFEST and n.endswith((".json", ".gz"))]
+        return {n[n.index(".json"):] for n in names}, len(names)
+
+    def test_switch_rewrites_unchanged_files(self):
+        self.download()
+        _, files = self.suffixes()
+        self.download(compression="gzip")
+        self.assertEqual(self.suffixes(), ({".json.gz"}, files))
+        self.download()
+        self.assertEqual(self.suffixes(), ({".json"}, files))
+
+    def test_incremental_converts_skipped_months(self):
+        full = self.download()
+        _, files = self.suffixes()
+        # 古い月は取り直さず、手元で書き直す
+        self.assertLess(
+            self.download(compression="gzip", incremental=True, lookback=0),
+            full)
+        self.assertEqual(self.suffixes(), ({".json.gz"}, files))
+
+    @unittest.skipIf("zstd" in rawstore.COMPRESSIONS, "zstandard is installed")
+    def test_zstd_without_package_fetches_nothing(self):
+        with MockServer(SyntheticData(3, 5, 3, 20)) as server:
+            Moneytree.origin = server.origin
+            with self.assertRaises(ImportError):
+                download(self.folder, "test", 3, compression="zstd")
+        self.assertEqual(server.request_count, 0)
+        self.assertEqual(os.listdir(self.folder), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+"""Journal と download(resume=True) の再開をモックサーバで確かめる
+
+```
+python3 -m pytest test_journal.py
+```
+"""
+import os
+import tempfile
+import unittest
+
+from mock_server import MockServer, StatusError, SyntheticData
+from moneytree_scraping import API, Journal, Moneytree, download
+
+
+class FailsCategory(SyntheticData):
+    """`fail`が真の間だけCATEGORYに403を返すAPI"""
+
+    fail = True
+
+    def handle(self, api, params):
+        if api == API.CATEGORY and self.fail:
+            raise StatusError(403)
+        return super().handle(api, params)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = Moneytree.origin
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+
+    def tearDown(self):
+        Moneytree.origin = self.origin
+        self.tmp.cleanup()
+
+    def download(self, data, months, resume=False):
+        with MockServer(data) as server:
+            Moneytree.origin = server.origin
+            failures = download(self.folder, "test", months, resume=resume)
+        return failures, server.request_count
+
+    def test_matching_run_is_kept(self):
+        Journal(self.folder, run={"months": 3}).record(["a.json", "b.json"])
+        with open(os.path.join(self.folder, Journal.filename), "a") as f:
+            f.write('{"done": "c.js')  # 書きかけの行
+        journal = Journal(self.folder, True, {"months": 3})
+        self.assertEqual(journal.done, {"a.json", "b.json"})
+        self.assertTrue(journal.is_done(["a.json"]))
+        self.assertFalse(journal.is_done(["a.json", "c.json"]))
+
+    def test_mismatched_run_is_discarded(self):
+        Journal(self.folder, run={"months": 3}).record(["a.json"])
+        journal = Journal(self.folder, True, {"months": 2})
+        self.assertEqual(journal.done, set())
+        # 捨てた記録は今回の条件で書き直される
+        self.assertEqual(Journal(self.folder, True, {"months": 2}).done,
+                         set())
+        self.assertEqual(Journal(self.folder, True, {"months": 3}).done,
+                         set())
+
+    def test_resume_fetches_only_failed_files(self):
+        data = FailsCategory(3, 5, 3, 20)
+        failures, _ = self.download(data, 3)
+        self.assertEqual(list(failures),
+                         [os.path.join(self.folder, "category.json")])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.folder, Journal.filename)))
+
+        data.fail = False
+        failures, requests = self.download(data, 3, resume=True)
+        self.assertEqual(failures, {})
+        self.assertEqual(requests, 1)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.folder, Journal.filename)))
+
+    def test_resume_with_other_months_fetches_everything(self):
+        data = FailsCategory(3, 5, 3, 20)
+        self.download(data, 3)
+
+        data.fail = False
+        _, requests = self.download(data, 2, resume=True)
+        _, full = self.download(data, 2)
+        self.assertEqual(requests, full)
+
+
+if __name__ == "__main__":
+    unittest.main()
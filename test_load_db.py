@@ -0,0 +1,105 @@
+"""load_db.load の差分取り込みをモックサーバのデータで確かめる
+
+```
+python3 -m pytest test_load_db.py
+```
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import load_db
+import rawstore
+from mock_server import MockServer, SyntheticData
+from moneytree_scraping import Moneytree, download
+
+
+class LoadDbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = Moneytree.origin
+        self.tmp = tempfile.TemporaryDirectory()
+        self.raw = os.path.join(self.tmp.name, "raw")
+        self.db = os.path.join(self.tmp.name, "moneytree.db")
+        os.makedirs(self.raw)
+        with MockServer(SyntheticData(3, 5, 3, 20)) as server:
+            Moneytree.origin = server.origin
+            self.assertEqual(download(self.raw, "test", 3), {})
+        load_db.load(self.raw, self.db)
+
+    def tearDown(self):
+        Moneytree.origin = self.origin
+        self.tmp.cleanup()
+
+    def query(self, sql, *params):
+        conn = sqlite3.connect(self.db)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def rewrite(self, name, edit):
+        path = os.path.join(self.raw, name)
+        data = rawstore.load(path)
+        edit(data)
+        with rawstore.atomic_write(path) as f:
+            f.write(json.dumps(data).encode())
+        return data
+
+    def months(self):
+        return [os.path.basename(p) for p in
+                rawstore.glob(self.raw, "transactions-*.json")]
+
+    def test_unchanged_files_change_nothing(self):
+        self.assertEqual(load_db.load(self.raw, self.db), 0)
+
+    def test_removed_transaction_is_deleted(self):
+        name = self.months()[0]
+        month = name[len("transactions-"):-len(".json")]
+        removed = []
+        self.rewrite(name,
+                     lambda d: removed.append(d["transactions"].pop()["id"]))
+        others = self.query(
+            "SELECT COUNT(*) FROM transactions WHERE month != ?", month)
+
+        self.assertEqual(load_db.load(self.raw, self.db), 1)
+        self.assertEqual(
+            self.query("SELECT id FROM transactions WHERE id = ?",
+                       removed[0]), [])
+        self.assertEqual(
+            self.query("SELECT COUNT(*) FROM transactions WHERE month = ?",
+                       month), [(19, )])
+        # 他の月の行は消えない
+        self.assertEqual(
+            self.query("SELECT COUNT(*) FROM transactions WHERE month != ?",
+                       month), others)
+
+    def test_emptied_month_is_cleared(self):
+        name = self.months()[0]
+        month = name[len("transactions-"):-len(".json")]
+        self.rewrite(name, lambda d: d["transactions"].clear())
+        load_db.load(self.raw, self.db)
+        self.assertEqual(
+            self.query("SELECT COUNT(*) FROM transactions WHERE month = ?",
+                       month), [(0, )])
+
+    def test_removed_account_is_deleted(self):
+        data = self.rewrite("account.json", lambda d: d["accounts"].pop())
+        self.assertEqual(load_db.load(self.raw, self.db), 1)
+        self.assertEqual(sorted(self.query("SELECT id FROM account")),
+                         sorted((a["id"], ) for a in data["accounts"]))
+
+    def test_refuses_other_databases(self):
+        other = os.path.join(self.tmp.name, "other.db")
+        conn = sqlite3.connect(other)
+        conn.execute("CREATE TABLE documents (id INTEGER)")
+        conn.commit()
+        conn.close()
+        with self.assertRaises(ValueError):
+            load_db.load(self.raw, other)
+
+
+if __name__ == "__main__":
+    unittest.main()
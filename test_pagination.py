@@ -0,0 +1,64 @@
+"""Moneytree.iter_transaction_pages のページングをモックサーバで確かめる
+
+```
+python3 -m pytest test_pagination.py
+```
+"""
+import unittest
+
+from mock_server import MockServer, SyntheticData
+from moneytree_scraping import API, Moneytree, _fetch
+
+
+class IgnoresPage(SyntheticData):
+    """`page`を無視して毎回先頭の500件を返し、pageも返さないAPI"""
+
+    def handle(self, api, params):
+        data = super().handle(api, dict(params, page=["1"]))
+        if api == API.TRANSACTIONS:
+            del data["transactions_details"]
+        return data
+
+
+class PaginationTest(unittest.TestCase):
+
+    def fetch_month(self, data):
+        with MockServer(data) as server:
+            Moneytree.origin = server.origin
+            with Moneytree("test") as mt:
+                start = data.months[0]
+                params = {"start_date": start.isoformat(),
+                          "end_date": start.replace(day=28).isoformat()}
+                pages = list(mt.iter_transaction_pages(**params))
+                merged = _fetch(mt, API.TRANSACTIONS, "t.json", params)
+            return pages, merged["t.json"], server.request_count
+
+    def setUp(self):
+        self.origin = Moneytree.origin
+
+    def tearDown(self):
+        Moneytree.origin = self.origin
+
+    def test_more_than_one_page(self):
+        pages, merged, _ = self.fetch_month(SyntheticData(2, 5, 1, 1203))
+        self.assertEqual([len(p["transactions"]) for p in pages],
+                         [500, 500, 203])
+        ids = [t["id"] for t in merged["transactions"]]
+        self.assertEqual(len(ids), 1203)
+        self.assertEqual(len(set(ids)), 1203)
+
+    def test_exact_multiple_of_per_page(self):
+        pages, merged, _ = self.fetch_month(SyntheticData(2, 5, 1, 1000))
+        self.assertEqual([len(p["transactions"]) for p in pages], [500, 500])
+        self.assertEqual(len(merged["transactions"]), 1000)
+
+    def test_page_ignored_by_api(self):
+        pages, merged, requests = self.fetch_month(IgnoresPage(2, 5, 1, 800))
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(len(merged["transactions"]), 500)
+        # 1ページ目と、同じ内容が返ってきた2ページ目を2回ずつ
+        self.assertEqual(requests, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
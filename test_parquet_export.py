@@ -0,0 +1,85 @@
+"""parquet_export.export の月パーティションの置き換えをモックサーバのデータで確かめる
+
+```
+python3 -m pytest test_parquet_export.py
+```
+"""
+import json
+import os
+import tempfile
+import unittest
+
+import pyarrow.dataset as ds
+
+import parquet_export
+import rawstore
+from mock_server import MockServer, SyntheticData
+from moneytree_scraping import Moneytree, download
+
+
+class ParquetExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = Moneytree.origin
+        self.tmp = tempfile.TemporaryDirectory()
+        self.raw = os.path.join(self.tmp.name, "raw")
+        self.out = os.path.join(self.tmp.name, "parquet")
+        os.makedirs(self.raw)
+        with MockServer(SyntheticData(3, 5, 3, 20)) as server:
+            Moneytree.origin = server.origin
+            self.assertEqual(download(self.raw, "test", 3), {})
+        parquet_export.export(self.raw, self.out)
+
+    def tearDown(self):
+        Moneytree.origin = self.origin
+        self.tmp.cleanup()
+
+    def rewrite(self, month, edit):
+        path = os.path.join(self.raw, f"transactions-{month}.json")
+        data = rawstore.load(path)
+        result = edit(data["transactions"])
+        with rawstore.atomic_write(path) as f:
+            f.write(json.dumps(data).encode())
+        return result
+
+    def months(self):
+        return sorted(os.path.basename(p)[len("transactions-"):-len(".json")]
+                      for p in rawstore.glob(self.raw, "transactions-*.json"))
+
+    def counts(self):
+        """{YYYY-MM: 行数} (transactionsデータセット)"""
+        base = os.path.join(self.out, "transactions")
+        counts = {}
+        for month in self.months():
+            folder = parquet_export.partition_dir(base, month)
+            if os.path.isdir(folder):
+                counts[month] = ds.dataset(folder).count_rows()
+        return counts
+
+    def test_every_month_is_exported(self):
+        self.assertEqual(self.counts(), {m: 20 for m in self.months()})
+        self.assertEqual(parquet_export.export(self.raw, self.out), [])
+
+    def test_emptied_month_is_cleared(self):
+        month = self.months()[0]
+        self.rewrite(month, lambda t: t.clear())
+        self.assertEqual(parquet_export.export(self.raw, self.out),
+                         [f"transactions-{month}.json"])
+        expected = {m: 20 for m in self.months()}
+        del expected[month]
+        self.assertEqual(self.counts(), expected)
+
+    def test_row_from_another_month_stays_in_its_file(self):
+        # 前月の日付の取引が入ったファイルを書き出しても、前月のパーティションは消えない
+        previous, month = self.months()[:2]
+        row = rawstore.load(os.path.join(
+            self.raw, f"transactions-{previous}.json"))["transactions"][0]
+        self.rewrite(month, lambda t: t.append(dict(row, id=-1)))
+        parquet_export.export(self.raw, self.out)
+        counts = {m: 20 for m in self.months()}
+        counts[month] = 21
+        self.assertEqual(self.counts(), counts)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+"""_fetch_spending_range の範囲分割をモックサーバで確かめる
+
+```
+python3 -m pytest test_spending_range.py
+```
+"""
+import time
+import unittest
+
+import requests
+from dateutil.relativedelta import relativedelta
+
+from mock_server import MockServer, StatusError, SyntheticData
+from moneytree_scraping import API, Moneytree, _fetch_spending_range
+
+
+class RejectsRanges(SyntheticData):
+    """複数月にまたがるSPENDINGに`status`を返すAPI。
+    `status`がNoneなら、応答を`delay`秒遅らせる。"""
+
+    def __init__(self, status, delay=0.0):
+        super().__init__(2, 5, 4, 1)
+        self.status = status
+        self.delay = delay
+
+    def handle(self, api, params):
+        if api == API.SPENDING and \
+                params["start_date"][0][:7] != params["end_date"][0][:7]:
+            if self.status is None:
+                time.sleep(self.delay)
+            else:
+                raise StatusError(self.status)
+        return super().handle(api, params)
+
+
+class SpendingRangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = Moneytree.origin
+
+    def tearDown(self):
+        Moneytree.origin = self.origin
+
+    def fetch(self, data, timeout=None):
+        months = [(m.strftime("%Y-%m"), m.strftime("spending-%Y-%m.json"),
+                   m.isoformat(),
+                   (m + relativedelta(months=1, days=-1)).isoformat())
+                  for m in reversed(data.months)]
+        with MockServer(data) as server:
+            Moneytree.origin = server.origin
+            with Moneytree("test", retries=0, throttle_retries=0) as mt:
+                if timeout is not None:
+                    mt.timeout = timeout
+                try:
+                    return (_fetch_spending_range(mt, months),
+                            [m[1] for m in months], server.request_count)
+                except requests.RequestException as e:
+                    return e, [m[1] for m in months], server.request_count
+
+    def assertSplit(self, data, timeout=None):
+        result, filenames, count = self.fetch(data, timeout)
+        self.assertIsInstance(result, dict)
+        self.assertEqual(sorted(result), sorted(filenames))
+        for filename, value in result.items():
+            self.assertEqual(len(value["category_totals"]), 1, filename)
+        # 4ヶ月 → 2ヶ月×2 → 1ヶ月×4
+        self.assertEqual(count, 7)
+
+    def assertNotSplit(self, data):
+        result, _, count = self.fetch(data)
+        self.assertIsInstance(result, requests.RequestException)
+        self.assertEqual(count, 1)
+
+    def test_bad_request_is_split(self):
+        self.assertSplit(RejectsRanges(400))
+
+    def test_too_large_is_split(self):
+        self.assertSplit(RejectsRanges(413))
+
+    def test_server_error_is_split(self):
+        self.assertSplit(RejectsRanges(500))
+
+    def test_timeout_is_split(self):
+        self.assertSplit(RejectsRanges(None, delay=1.0), timeout=0.3)
+
+    def test_forbidden_is_not_split(self):
+        self.assertNotSplit(RejectsRanges(403))
+
+    def test_throttled_is_not_split(self):
+        self.assertNotSplit(RejectsRanges(429))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+"""Bearerトークンの管理
+
+login.py が保存した bearer_token を読み、有効期限内ならそのまま使います。
+accessTokenはJWT形式なので、payloadの`exp`から期限を判定します。
+期限切れ、または途中で401になったときだけ login.py (Selenium) を実行します。
+
+# Usage
+
+```
+python3 token_manager.py   # 有効なトークンがなければログインする
+```
+
+```python
+tokens = TokenManager()
+mt = Moneytree(tokens.get(), token_refresher=tokens.refresh)
+```
+"""
+import base64
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Optional
+
+LOGIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "login.py")
+
+
+def expires_at(token: str) -> Optional[float]:
+    """JWTのexp(UNIX時刻)。JWTとして読めなければNone"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenManager:
+    """bearer_tokenファイルの読み込みと、必要なときだけの再ログイン
+
+    `margin`秒以内に期限が切れるトークンは期限切れとして扱います。
+    """
+
+    def __init__(self,
+                 path: str = "./bearer_token",
+                 login_script: str = LOGIN_SCRIPT,
+                 margin: float = 300,
+                 env: Optional[dict] = None):
+        self.path = path
+        self.login_script = login_script
+        self.margin = margin
+        # login.pyに渡す追加の環境変数 (MT_EMAIL, MT_PASSWORD など)
+        self.env = env
+        self._lock = threading.Lock()
+
+    def read(self) -> Optional[str]:
+        try:
+            with open(self.path, mode="r", encoding="utf-8") as f:
+                token = f.readline().replace("\n", "", -1).replace(
+                    "Bearer ", "")
+        except FileNotFoundError:
+            return None
+        return token or None
+
+    def is_valid(self, token: Optional[str]) -> bool:
+        """期限内か。expが読めないトークンは有効とみなし、401で判断する"""
+        if not token:
+            return False
+        exp = expires_at(token)
+        return exp is None or exp - self.margin > time.time()
+
+    def login(self, stale: Optional[str] = None) -> str:
+        """login.pyを実行してトークンを取り直す。
+
+        login.pyは実行したフォルダのbearer_tokenに書くので、`path`の名前が違うと
+        古いトークンを読み直すことになる。`stale`と同じトークンしか読めなければ例外にする。
+        """
+        subprocess.run([sys.executable, self.login_script],
+                       cwd=os.path.dirname(os.path.abspath(self.path)),
+                       env=dict(os.environ, **(self.env or {})),
+                       check=True)
+        token = self.read()
+        if token is None:
+            raise RuntimeError(f"login.py did not write {self.path}")
+        if token == stale:
+            raise RuntimeError(f"login.py did not update {self.path}")
+        return token
+
+    def get(self) -> str:
+        """有効なトークン。期限切れならログインする"""
+        with self._lock:
+            token = self.read()
+            if self.is_valid(token):
+                return token
+            return self.login(token)
+
+    def refresh(self, expired: str) -> str:
+        """401になったトークンを渡すと、新しいトークンを返す。
+
+        並行したリクエストが同時に401になっても、ログインは1回だけ行う。
+        """
+        with self._lock:
+            token = self.read()
+            if token and token != expired and self.is_valid(token):
+                return token
+            return self.login(expired)
+
+
+if __name__ == "__main__":
+    manager = TokenManager()
+    token = manager.get()
+    exp = expires_at(token)
+    if exp is not None:
+        print("token expires at "
+              + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(exp)))